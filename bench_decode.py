@@ -0,0 +1,137 @@
+#!/usr/bin/python
+"""
+Description: Intel HEX and S-record decoding benchmark for burn.py
+
+Builds a random binary image with a hole in the middle for each size, encodes
+it as Intel HEX (with extended linear address records) and as S3 records, and
+times burn.decode_image on each against a plain per-byte int(x, 16) decoder.
+Decoding results are checked by test_burn.py, not here.
+
+    prompt% python bench_decode.py --sizes 1M,8M,32M -n 3
+"""
+import sys
+import os
+import time
+import tempfile
+import optparse
+import burn
+
+RECORD_BYTES = 32
+FILL_BYTE = 0xFF
+BASE_ADDRESS = 0x10000
+
+
+
+def checksum(record_bytes):
+    return (-sum(bytearray(record_bytes))) & 0xFF
+
+
+def intel_hex_record(record_type, offset, data):
+    body = chr(len(data)) + chr(offset >> 8) + chr(offset & 0xFF) + chr(record_type) + data
+    return ':%s%02X\n' % (body.encode('hex').upper(), checksum(body))
+
+
+def encode_intel_hex(chunks):
+    """
+    Encode (address, data) chunks as Intel HEX text.  Chunks start on a record
+    boundary so no record crosses a 64K segment.
+    """
+    lines = []
+    upper = None
+    for address, data in chunks:
+        assert address % RECORD_BYTES == 0
+        for offset in range(0, len(data), RECORD_BYTES):
+            record_address = address + offset
+            if record_address >> 16 != upper:
+                upper = record_address >> 16
+                lines.append(intel_hex_record(4, 0, chr(upper >> 8) + chr(upper & 0xFF)))
+            lines.append(intel_hex_record(0, record_address & 0xFFFF, data[offset:offset + RECORD_BYTES]))
+    lines.append(intel_hex_record(1, 0, ''))
+    return ''.join(lines)
+
+
+def encode_srecord(chunks):
+    """ Encode (address, data) chunks as S3 records """
+    lines = [ 'S0030000FC\n' ]
+    for address, data in chunks:
+        for offset in range(0, len(data), RECORD_BYTES):
+            piece = data[offset:offset + RECORD_BYTES]
+            body = chr(len(piece) + 5) + ('%08X' % (address + offset)).decode('hex') + piece
+            lines.append('S3%s%02X\n' % (body.encode('hex').upper(), 0xFF - (sum(bytearray(body)) & 0xFF)))
+    lines.append('S70500000000FA\n')
+    return ''.join(lines)
+
+
+def naive_decode(text, image_type):
+    """ Reference decoder: every byte through int(x, 16), no checks """
+    image = {}
+    upper = 0
+    for line in text.split():
+        if image_type == 'I':
+            values = [int(line[i:i + 2], 16) for i in range(1, len(line), 2)]
+            if values[3] == 0:
+                address = upper + (values[1] << 8) + values[2]
+                for i, value in enumerate(values[4:-1]):
+                    image[address + i] = value
+            elif values[3] == 4:
+                upper = ((values[4] << 8) + values[5]) << 16
+        elif line[1] == '3':
+            values = [int(line[i:i + 2], 16) for i in range(2, len(line), 2)]
+            address = (values[1] << 24) + (values[2] << 16) + (values[3] << 8) + values[4]
+            for i, value in enumerate(values[5:-1]):
+                image[address + i] = value
+    base = min(image)
+    out = bytearray(chr(FILL_BYTE)) * (max(image) + 1 - base)
+    for address, value in image.iteritems():
+        out[address - base] = value
+    return str(out)
+
+
+def decode_with_burn(path, image_type):
+    options = optparse.Values({ 'type' : image_type, 'fill' : '0x%X' % FILL_BYTE, 'verbose' : False })
+    return burn.decode_image(options, burn.get_input_file_data(path, sys.maxsize))
+
+
+def best_time(func, iterations):
+    """ Fastest of iterations calls to func(), returns (seconds, result) """
+    times = []
+    for iteration in range(iterations):
+        start = time.time()
+        result = func()
+        times.append(time.time() - start)
+    return min(times), result
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('-s', '--sizes', default='256K,1M,8M', help='image sizes to test [default 256K,1M,8M]')
+    parser.add_option('-n', '--iterations', type='int', default=3, help='runs per size [default 3]')
+    parser.add_option('--no-reference', action='store_true', help="don't time the per-byte reference decoder")
+    (options, args) = parser.parse_args()
+
+    print '%6s\t%-4s\t%10s\t%10s\t%10s\t%8s' % ('Size', 'Type', 'text MB', 'burn ms', 'burn MB/s', 'ref ms')
+    for size in options.sizes.split(','):
+        image_len = burn.number_with_metric_suffix_to_val(size)
+        data = os.urandom(image_len)
+        hole = (image_len / 2, image_len / 2 + image_len / 8)
+        chunks = [ (BASE_ADDRESS, data[:hole[0]]), (BASE_ADDRESS + hole[1], data[hole[1]:]) ]
+
+        for image_type, encode in [ ('I', encode_intel_hex), ('M', encode_srecord) ]:
+            text = encode(chunks)
+            handle = tempfile.NamedTemporaryFile(suffix='.txt')
+            handle.write(text)
+            handle.flush()
+            burn_time, image = best_time(lambda: decode_with_burn(handle.name, image_type), options.iterations)
+            ref_text = '-'
+            if not options.no_reference:
+                ref_time, reference = best_time(lambda: naive_decode(text, image_type), 1)
+                ref_text = '%.0f' % (ref_time * 1e3)
+            handle.close()
+            print '%6s\t%-4s\t%10.1f\t%10.1f\t%10.1f\t%8s' % (size, image_type, len(text) / 1e6, burn_time * 1e3,
+                                                            len(text) / 1e6 / burn_time, ref_text)
+            sys.stdout.flush()
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+"""
+Description: Platform detection microbenchmark for burn.py
+
+Times the single pass PlatformMatcher against the old one-regex-per-platform
+scan on random images of several sizes, with the marker of a platform near the
+end of PLATFORM_LIST (the old scan's worst case) placed near the end of the
+image, and checks both pick the same platform.
+
+    prompt% python bench_detect.py --sizes 1M,8M,32M -n 5
+"""
+import sys
+import os
+import re
+import time
+import optparse
+import burn
+
+
+
+def legacy_find_platform(data):
+    """ The scan autodetect_find_platform used to do: one pass per platform """
+    for platform in burn.PLATFORM_LIST:
+        binary_search = re.compile(b"SonicWALL,%s" % platform.name.capitalize())
+        if binary_search.search(data):
+            return platform
+    return None
+
+
+def make_image(size, platform):
+    marker = "SonicWALL,%s" % platform.name.capitalize()
+    body = os.urandom(size - len(marker))
+    offset = len(body) - len(body) / 16
+    return body[:offset] + marker + body[offset:]
+
+
+def best_time(func, data, iterations):
+    """ Fastest of iterations calls to func(data), returns (seconds, result) """
+    times = []
+    for iteration in range(iterations):
+        start = time.time()
+        result = func(data)
+        times.append(time.time() - start)
+    return min(times), result
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('-s', '--sizes', default='1M,8M,32M', help='image sizes to test [default 1M,8M,32M]')
+    parser.add_option('-n', '--iterations', type='int', default=5, help='runs per size [default 5]')
+    parser.add_option('-p', '--platform', default=burn.PLATFORM_LIST[-2].name, help='platform marker to plant')
+    (options, args) = parser.parse_args()
+
+    platforms = [p for p in burn.PLATFORM_LIST if p.name == options.platform]
+    if not platforms:
+        sys.stderr.write("Error: unknown platform %s\n" % options.platform)
+        sys.exit(-1)
+
+    print '%6s\t%10s\t%10s\t%8s\t%s' % ('Size', 'legacy ms', 'single ms', 'speedup', 'Platform')
+    for size in options.sizes.split(','):
+        data = make_image(burn.number_with_metric_suffix_to_val(size), platforms[0])
+        legacy_time, legacy = best_time(legacy_find_platform, data, options.iterations)
+        single_time, single = best_time(burn.PLATFORM_MATCHER.find, data, options.iterations)
+        if legacy is not single:
+            sys.stderr.write("Error: detection mismatch at %s: %s != %s\n" % (size, legacy.name, single.name))
+            sys.exit(-1)
+        print '%6s\t%10.1f\t%10.1f\t%7.1fx\t%s' % (size, legacy_time * 1e3, single_time * 1e3,
+                                                  legacy_time / single_time, single.name)
+        sys.stdout.flush()
+
+
+
+if __name__ == "__main__":
+    main()
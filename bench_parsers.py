@@ -0,0 +1,62 @@
+#!/usr/bin/python
+"""
+Description: Compare the outlet page parsers on recorded pages
+
+Runs the regex scanner and the BeautifulSoup fallback from dli.py over every
+DLI page in the fixtures directory, checks that both produce the same rows, and
+prints the time per parse for each.
+
+    prompt% python bench_parsers.py -n 500
+"""
+import sys
+import os
+import glob
+import timeit
+import optparse
+import dli
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+
+def _same_rows(fast_rows, soup_rows):
+    """ BeautifulSoup hands back unicode strings; compare on plain values """
+    if fast_rows is None or soup_rows is None:
+        return fast_rows == soup_rows
+    normalized = [[int(row[0]), str(row[1]), str(row[2])] for row in soup_rows]
+    return fast_rows == normalized
+
+
+def bench_page(filename, iterations):
+    """ Time both parsers on one page, return (fast secs, soup secs, agree) """
+    page = open(filename).read()
+    agree = _same_rows(dli.parse_outlet_table(page), dli.parse_outlet_table_soup(page))
+    fast = timeit.Timer(lambda: dli.parse_outlet_table(page)).timeit(iterations) / iterations
+    soup = timeit.Timer(lambda: dli.parse_outlet_table_soup(page)).timeit(iterations) / iterations
+    return fast, soup, agree
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [fixture ...]")
+    parser.add_option('-n', '--iterations', type='int', default=200, help='parses per page [default 200]')
+    (options, args) = parser.parse_args()
+
+    pages = args or sorted(glob.glob(os.path.join(FIXTURE_DIR, 'dli_*.htm')))
+    if not pages:
+        sys.stderr.write("No DLI fixtures found in %s\n" % FIXTURE_DIR)
+        sys.exit(-1)
+
+    error = 0
+    print '%-24.24s\t%10s\t%10s\t%8s\t%s' % ('Page', 'regex us', 'soup us', 'speedup', 'Rows match')
+    for filename in pages:
+        fast, soup, agree = bench_page(filename, options.iterations)
+        print '%-24.24s\t%10.1f\t%10.1f\t%7.1fx\t%s' % (os.path.basename(filename), fast * 1e6, soup * 1e6,
+                                                        soup / fast, agree and 'yes' or 'NO')
+        if not agree:
+            error = 1
+    sys.exit(error)
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+"""
+Description: Cold-start time per lpower command
+
+Runs each offline lpower1 command in a fresh interpreter several times and
+reports the best and median wall time.  Each run also records whether pycurl or
+BeautifulSoup got imported; offline commands must not pull them in.  The
+script exits non-zero if a command is over the time budget or imported a
+network module, so it can guard against startup regressions.
+
+Commands run against a scratch HOME so real settings, sessions and a running
+daemon are never touched.
+
+    prompt% python bench_startup.py -n 20 --budget 100
+"""
+import sys
+import os
+import time
+import shutil
+import tempfile
+import subprocess
+import optparse
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+OFFLINE_COMMANDS = [ ['help'],
+                     ['list-aliases'],
+                     ['list-settings'],
+                     ['list-ports'],
+                     ['alias', '1', 'bench'],
+                     ['clear', 'bench'] ]
+NETWORK_MODULES = [ 'pycurl', 'BeautifulSoup' ]
+
+# Run the CLI as __main__ and report the network modules loaded when it exits
+_RUNNER = """
+import sys, atexit, runpy
+def report():
+    loaded = [name for name in %r if name in sys.modules]
+    open(%r, 'w').write(' '.join(loaded))
+atexit.register(report)
+sys.argv = sys.argv[1:]
+runpy.run_path(sys.argv[0], run_name='__main__')
+"""
+
+
+
+def time_command(python, script, argv, env, report_file):
+    """ Run one command, return (seconds, network modules imported) """
+    runner = _RUNNER % (NETWORK_MODULES, report_file)
+    start = time.time()
+    subprocess.call([python, '-c', runner, script] + argv, env=env,
+                    stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+    elapsed = time.time() - start
+    try:
+        loaded = open(report_file).read().split()
+    except IOError:
+        loaded = []
+    return elapsed, loaded
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('-n', '--runs', type='int', default=10, help='runs per command [default 10]')
+    parser.add_option('-b', '--budget', type='float', default=150.0, help='median ms allowed per command [default 150]')
+    parser.add_option('-s', '--script', default=os.path.join(SCRIPT_DIR, 'lpower1'), help='CLI script to time')
+    parser.add_option('-c', '--config', help='switch config file to run with (default: none)')
+    parser.add_option('--python', default=sys.executable, help='interpreter to use')
+    (options, args) = parser.parse_args()
+
+    home = tempfile.mkdtemp(prefix='lpower-bench-')
+    env = dict(os.environ)
+    env['HOME'] = home
+    env['PYTHONPATH'] = os.pathsep.join([SCRIPT_DIR, env.get('PYTHONPATH', '')])
+    env.pop('LPOWER_CONFIG', None)
+    if options.config:
+        env['LPOWER_CONFIG'] = os.path.abspath(options.config)
+    report_file = os.path.join(home, 'modules')
+
+    error = 0
+    baseline, loaded = time_command(options.python, os.devnull, [], env, report_file)
+    print 'Interpreter alone: %.1f ms' % (baseline * 1e3)
+    print '%-20.20s\t%8s\t%8s\t%s' % ('Command', 'best ms', 'median ms', 'Network imports')
+    try:
+        for argv in OFFLINE_COMMANDS:
+            times = []
+            for run in range(options.runs):
+                elapsed, loaded = time_command(options.python, options.script, argv, env, report_file)
+                times.append(elapsed)
+            times.sort()
+            median = times[len(times) / 2] * 1e3
+            status = ''
+            if median > options.budget:
+                status = '  OVER BUDGET'
+                error = 1
+            if loaded:
+                error = 1
+            print '%-20.20s\t%8.1f\t%8.1f\t%s%s' % (' '.join(argv), times[0] * 1e3, median,
+                                                    ' '.join(loaded) or 'none', status)
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+    sys.exit(error)
+
+
+
+if __name__ == "__main__":
+    main()
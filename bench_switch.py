@@ -0,0 +1,142 @@
+#!/usr/bin/python
+"""
+Description: End-to-end switch benchmark against simulated strips
+
+Starts pwrsim.py with a farm of simulated strips for each rack size, builds a
+VirtualPowerSwitch from the config file it writes and times whole-rack status,
+on, off and reset operations.  Prints the median and 95th percentile latency
+of each operation and the outlet throughput it implies.  Errors raised by an
+operation (e.g. from --failure-rate) are counted, not fatal.  With --async the
+same rack is driven through pwrasync from one event loop instead (no reset,
+which the async API doesn't have).
+
+    prompt% python bench_switch.py --strips 1,10,100 -n 10 --latency 0.01
+"""
+import sys
+import os
+import time
+import shutil
+import tempfile
+import subprocess
+import optparse
+import vswitch
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+OPERATIONS = [ 'status', 'on', 'off', 'reset-native', 'reset-timed' ]
+ASYNC_OPERATIONS = [ 'status', 'on', 'off' ]
+
+
+
+def start_simulator(options, count, directory):
+    """ Run pwrsim.py in its own process, return (process, config file) """
+    config = os.path.join(directory, 'sim%d.conf' % count)
+    argv = [ options.python, os.path.join(SCRIPT_DIR, 'pwrsim.py'), '-n', str(count), '-t', options.type,
+             '-l', str(options.latency), '-j', str(options.jitter), '-f', str(options.failure_rate),
+             '--cycle-delay', '0', '-c', config ]
+    process = subprocess.Popen(argv, stdout=open(os.devnull, 'w'))
+    deadline = time.time() + 30
+    while not os.path.exists(config):
+        if process.poll() is not None or time.time() > deadline:
+            raise Exception("Simulator for %d strips did not start" % count)
+        time.sleep(0.05)
+    return process, config
+
+
+def run_async_operation(loop, switch, operation, ports):
+    if operation == 'status':
+        loop.run(switch.status_list())
+    elif operation == 'on':
+        loop.run(switch.set_outlets(dict([(port, 'ON') for port in ports])))
+    elif operation == 'off':
+        loop.run(switch.set_outlets(dict([(port, 'OFF') for port in ports])))
+
+
+def run_operation(switch, operation, ports):
+    if operation == 'status':
+        switch.status_list()
+    elif operation == 'on':
+        switch.set_outlets(dict([(port, 'ON') for port in ports]))
+    elif operation == 'off':
+        switch.set_outlets(dict([(port, 'OFF') for port in ports]))
+    elif operation == 'reset-native':
+        # Ports that are off get a 0 second timed reset instead of the default
+        switch.reset(dict([(port, vswitch.NATIVE_CYCLE) for port in ports]), 0)
+    elif operation == 'reset-timed':
+        switch.reset(dict([(port, 0) for port in ports]))
+
+
+def time_operation(run, operation, ports, iterations):
+    """ Time run(operation, ports), returns (sorted seconds per run, errors) """
+    times = []
+    errors = 0
+    for iteration in range(iterations):
+        start = time.time()
+        try:
+            run(operation, ports)
+        except Exception:
+            errors += 1
+        times.append(time.time() - start)
+    times.sort()
+    return times, errors
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('-s', '--strips', default='1,10,50,100', help='rack sizes to test [default 1,10,50,100]')
+    parser.add_option('-n', '--iterations', type='int', default=10, help='runs per operation [default 10]')
+    parser.add_option('-t', '--type', default='mixed', help='dli, stech or mixed [default mixed]')
+    parser.add_option('-l', '--latency', type='float', default=0.0, help='simulated seconds per request')
+    parser.add_option('-j', '--jitter', type='float', default=0.0, help='extra random seconds, up to this')
+    parser.add_option('-f', '--failure-rate', type='float', default=0.0, help='fraction of requests failing')
+    parser.add_option('-o', '--operations', help='operations to time [default all]')
+    parser.add_option('-a', '--async', action='store_true', help='drive the rack through pwrasync')
+    parser.add_option('--max-connections', type='int', default=64, help='async transfers in flight [default 64]')
+    parser.add_option('--python', default=sys.executable, help='interpreter for the simulator')
+    (options, args) = parser.parse_args()
+
+    known = options.async and ASYNC_OPERATIONS or OPERATIONS
+    operations = (options.operations or ','.join(known)).split(',')
+    for operation in operations:
+        if not operation in known:
+            sys.stderr.write("Error: unknown operation %s (%s)\n" % (operation, ', '.join(known)))
+            sys.exit(-1)
+
+    directory = tempfile.mkdtemp(prefix='lpower-sim-')
+    print '%6s\t%-12s\t%10s\t%10s\t%12s\t%s' % ('Strips', 'Operation', 'median ms', 'p95 ms', 'outlets/s', 'Errors')
+    try:
+        for count in [int(value) for value in options.strips.split(',')]:
+            process, config = start_simulator(options, count, directory)
+            try:
+                if options.async:
+                    import pwrasync
+                    loop = pwrasync.Loop(max_connections=options.max_connections)
+                    switch = pwrasync.build_switch(loop, *vswitch.read_config(config))
+                    for dev in switch.switches:
+                        dev.status_cache.ttl = 0
+                    run = lambda operation, ports: run_async_operation(loop, switch, operation, ports)
+                    loop.run(switch.status_list()) # Open the connections and log in
+                else:
+                    switch = vswitch.build_switch(*vswitch.read_config(config))
+                    switch.set_status_ttl(0)
+                    run = lambda operation, ports: run_operation(switch, operation, ports)
+                    switch.status_list() # Open the connections and log in
+                ports = range(1, switch.get_num_ports() + 1)
+                for operation in operations:
+                    if operation == 'reset-native':
+                        run('on', ports) # The strip only cycles outlets that are on
+                    times, errors = time_operation(run, operation, ports, options.iterations)
+                    median = times[len(times) / 2]
+                    p95 = times[min(len(times) - 1, int(len(times) * 0.95))]
+                    print '%6d\t%-12s\t%10.1f\t%10.1f\t%12.0f\t%d' % (count, operation, median * 1e3, p95 * 1e3,
+                                                                    len(ports) / median, errors)
+                    sys.stdout.flush()
+            finally:
+                process.terminate()
+                process.wait()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+
+if __name__ == "__main__":
+    main()
@@ -54,6 +54,37 @@ Data can also be taken from stdin by using '-' as the file name.
 Using stdin is useful for piping data from other commands, network pipes, etc.
 Note that file name autodetection will not work in this case.
 
+Images are never copied into the script.  Regular files (and stdin redirected
+from one) are memory mapped; a stdin pipe is spooled in chunks to an unlinked
+temporary file and mapped the same way.  The image and then the fill bytes are
+streamed into pjet a chunk at a time, so memory use stays flat no matter how
+big the device is or how many burns run at once.
+
+
+Intel HEX and Motorola S-record
+===============================
+
+Images of type I (Intel HEX) and M (Motorola S-record) are decoded to binary
+before anything else happens, so autodetection, sizing, padding and the cache
+all see the real image and pjet is sent binary data.  The binary image starts
+at the lowest address in the file and gaps between records are filled with the
+--fill byte.
+
+    prompt% burn.py -t I u-boot-octeon_maple.hex
+
+
+Prepared Image Cache
+====================
+
+Burning the same build to many Promjets re-reads, autodetects and pads the same
+image every time.  Give a cache directory with --cache-dir (or the
+PJET_CACHE_DIR environment variable) to keep each prepared image on disk.  A
+repeat burn of the same input with the same requested size, width, swap and
+fill maps the cached image and skips autodetection and padding.  The least
+recently used images are removed once the cache grows past --cache-size.
+
+    prompt% burn.py --cache-dir ~/.pjet-cache u-boot-octeon_maple.bin
+
 
 Carefully Control Settings
 ==========================
@@ -85,6 +116,15 @@ pertinent parameters.
     prompt% burn.py -d 2 u-boot-octeon_mahogany.bin
 
 
+Burn the same image to several Promjets at once.  Devices can be listed, given
+as ranges, or 'all' for every Promjet lsusb shows.  The image is prepared once
+and fed to one pjet per device, at most --jobs at a time, and the result of
+each device is reported at the end.  Any -d list gets this report, and burn.py
+exits non-zero if a device failed.
+
+    prompt% burn.py -d 1,3,5-8 u-boot-octeon_maple.bin
+
+
 Send an image over the network to a remote system with a Promjet via ssh.  Uses
 stdin on the remote side to read the image in the burn.py script.  Also note
 explicit control of width and swap settings.  Autodetection could have been used
@@ -120,6 +160,17 @@ use the -n switch.  Added the verbose flag for as much info as possible.
 import sys
 import os
 import re
+import time
+import json
+import mmap
+import hashlib
+import binascii
+import struct
+import stat
+import tempfile
+import subprocess
+import threading
+import Queue
 import optparse
 
 
@@ -150,6 +201,20 @@ METRIC_SUFFIXES = { 'K' : 1024,
 PJET_WIDTH_ENV_VAR = 'PJET_WIDTH'
 PJET_SIZE_ENV_VAR = 'PJET_SIZE'
 PJET_SWAP_ENV_VAR = 'PJET_SWAP'
+PJET_CACHE_DIR_ENV_VAR = 'PJET_CACHE_DIR'
+# Text image input is decoded a block of about this many bytes at a time
+DECODE_BLOCK_LEN = 1024 * 1024
+TEXT_WHITESPACE = ' \t\r\n\f\v'
+# The 'S' and type digit that start an S-record
+SRECORD_START = re.compile('S([0-9])')
+# S-record data record types and their address lengths in bytes
+SRECORD_ADDRESS_BYTES = { '1' : 2, '2' : 3, '3' : 4 }
+# Data records gathered before joining them into one block of a run
+RUN_BLOCK_RECORDS = 256
+# lsusb lines that are Promjets, for '-d all'
+PROMJET_USB_PATTERN = re.compile('emutec|promjet', re.IGNORECASE)
+# Bytes per write to pjet and per read when spooling a stdin pipe
+STREAM_CHUNK_SIZE = 64 * 1024
 
 class PlatformSpec():
     def __init__(self, name, width=8, swap=False, size=''):
@@ -181,6 +246,160 @@ PLATFORM_LIST = [ PlatformSpec('uboot-mvebu', width=1, size='16M'),
                   PlatformSpec('thunder-bootfs-uboot-t81', width=1, size='16M')]
 
 
+class PlatformMatcher():
+    """
+    Find the 'SonicWALL,<Name>' markers of a list of platforms in one pass over
+    the image.  All names go into a single regex alternation, longest first so
+    the full name wins when one is a prefix of another.
+    """
+    def __init__(self, platforms):
+        self.platforms = platforms
+        self.by_marker = {}
+        for platform in platforms:
+            self.by_marker.setdefault(platform.name.capitalize(), platform)
+        markers = sorted(self.by_marker, key=len, reverse=True)
+        self.regex = re.compile(b"SonicWALL,(%s)" % "|".join([re.escape(m) for m in markers]))
+        # A marker also contains every shorter name that is a prefix of it;
+        # remember which of those comes first in the platform list
+        self.first_platform = {}
+        for marker in markers:
+            candidates = [p for p in platforms if marker.startswith(p.name.capitalize())]
+            self.first_platform[marker] = min(candidates, key=platforms.index)
+
+    def find_all(self, data):
+        """ Return (offset, platform) for every marker in data, in offset order """
+        return [(match.start(), self.by_marker[match.group(1)]) for match in self.regex.finditer(data)]
+
+    def find(self, data):
+        """
+        Return the platform that comes first in the platform list among those
+        with a marker in data, or None.
+        """
+        found = [self.first_platform[match.group(1)] for match in self.regex.finditer(data)]
+        if not found:
+            return None
+        return min(found, key=self.platforms.index)
+
+PLATFORM_MATCHER = PlatformMatcher(PLATFORM_LIST)
+
+
+class ImageCache():
+    """
+    On-disk cache of images already truncated and padded for the programmer.
+    An entry is a <key>.img file holding exactly the bytes pjet is sent and a
+    <key>.json file with the width, size and swap settings they were prepared
+    with.  The key hashes the input contents with the settings requested before
+    autodetection, so a hit skips autodetection as well as padding.  Files are
+    renamed into place so concurrent burns never see half an entry.  A hit
+    refreshes the entry's mtime; after a store the least recently used entries
+    are removed once the images add up to more than max_bytes, but never the
+    one just stored.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    def key(self, options, data):
+        """ Hash the input data and the settings that decide how it's prepared """
+        digest = hashlib.sha1()
+        for offset in xrange(0, len(data), STREAM_CHUNK_SIZE):
+            digest.update(buffer(data, offset, STREAM_CHUNK_SIZE))
+        settings = (options.size, options.width, options.swap, int(options.fill, 16), options.type.upper(),
+                    options.manual_mode, os.path.basename(options.input_filename))
+        digest.update(repr(settings))
+        return digest.hexdigest()
+
+    def lookup(self, key, options, touch=True):
+        """
+        Map the image for key and apply its settings to options.  Return None if
+        there's no complete entry.  With touch false the entry's mtime is left
+        alone, for runs that won't burn anything.
+        """
+        try:
+            handle = open(self._path(key, '.json'))
+            try:
+                settings = json.load(handle)
+            finally:
+                handle.close()
+            handle = open(self._path(key, '.img'), 'rb')
+            try:
+                data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                handle.close()
+        except (EnvironmentError, ValueError):
+            return None
+
+        if touch:
+            try:
+                os.utime(self._path(key, '.img'), None)
+            except OSError:
+                pass
+        for name in [ 'width', 'size', 'swap' ]:
+            value = settings.get(name)
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            setattr(options, name, value)
+        return data
+
+    def store(self, key, options, data, image_len, padding_len, padding_byte):
+        """ Write the prepared image for key, evict old entries and return the new one mapped """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        write_image = lambda handle: write_programmer_data(handle, data, image_len, padding_len, padding_byte)
+        self._write_atomically(self._path(key, '.img'), write_image)
+        settings = { 'width' : options.width, 'size' : options.size, 'swap' : options.swap }
+        self._write_atomically(self._path(key, '.json'), lambda handle: json.dump(settings, handle))
+
+        handle = open(self._path(key, '.img'), 'rb')
+        try:
+            prepared = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            handle.close()
+        self.evict(keep=key)
+        return prepared
+
+    def _write_atomically(self, path, write_func):
+        handle = tempfile.NamedTemporaryFile(dir=self.directory, prefix='.', suffix='.tmp', delete=False)
+        try:
+            write_func(handle)
+            handle.close()
+            os.rename(handle.name, path)
+        except:
+            handle.close()
+            os.remove(handle.name)
+            raise
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used entries until the images fit in max_bytes.
+        The entry for keep is never removed, even if it alone is too big.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.img'):
+                continue
+            try:
+                info = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((info.st_mtime, info.st_size, name[:-len('.img')]))
+        entries.sort()
+
+        total = sum([size for mtime, size, key in entries])
+        entries = [ entry for entry in entries if entry[2] != keep ]
+        while total > self.max_bytes and entries:
+            mtime, size, key = entries.pop(0)
+            for suffix in [ '.img', '.json' ]:
+                try:
+                    os.remove(self._path(key, suffix))
+                except OSError:
+                    pass
+            total -= size
+
+
 
 def main():
     """
@@ -195,7 +414,8 @@ def main():
     parser.add_option('-P', '--no_padding', dest='no_padding', action='store_true', help='Do not pad image. Useful to preserve content of the PJET)')
     parser.add_option('-S', '--swap', help='set swap on or off on xfer (on, off, 0, 1, yes, no, y, n)')
     parser.add_option('--enable-ice', action='store_true', help='Enable ICE feature')
-    parser.add_option('-d', '--device', help='select device if multiple devices are present at one time')
+    parser.add_option('-d', '--device', help='select device(s) if multiple devices are present at one time (2, 1,3, 1-4 or all)')
+    parser.add_option('-j', '--jobs', type='int', default=4, help='burn at most this many devices at once [default 4]')
     parser.add_option('-f', '--fill', default='0xFF', help='set fill byte value [default 0xFF]')
     parser.add_option('-s', '--size', help='set Promjet size [memory addresses] (%s)' % device_size_descriptions)
     parser.add_option('-w', '--width', help='Promjet bus width (%s)' % widths)
@@ -204,6 +424,8 @@ def main():
     parser.add_option('-n', dest='fake_run', action='store_true', help='Dont run pjet command - just print what would happen to stdout')
     parser.add_option('-v', '--verbose', action='store_true', help='Print verbose output')
     parser.add_option('--pjet-command', help='Specify pjet binary to run')
+    parser.add_option('--cache-dir', help='Keep prepared images in this directory for reuse (or set %s)' % PJET_CACHE_DIR_ENV_VAR)
+    parser.add_option('--cache-size', default='256M', help='Evict least recently used cached images beyond this size [default 256M]')
 
 
     # ----- Options -----
@@ -214,7 +436,11 @@ def main():
     options.input_filename = args[0]
 
     # Need to read the input filename to do autodetection
-    programmer_data = get_input_file_data(options.input_filename)
+    # Text images are decoded to binary, so map all of them
+    max_input_len = None
+    if options.type.upper() in IMAGE_DECODERS:
+        max_input_len = sys.maxsize
+    programmer_data = get_input_file_data(options.input_filename, max_input_len)
 
     error = basic_option_check(options)
     if error:
@@ -223,7 +449,25 @@ def main():
     # Options are specified three possible ways: on the command line, env vars,
     # and with autodetection.  Priority is given in the order listed.
     detect_env_options(options)
-    if not options.manual_mode:
+
+    # A cached image was prepared with the settings autodetection would find
+    cache = cache_key = prepared_data = None
+    if options.cache_dir and not options.no_padding:
+        cache = ImageCache(options.cache_dir, number_with_metric_suffix_to_val(options.cache_size))
+        cache_key = cache.key(options, programmer_data)
+        prepared_data = cache.lookup(cache_key, options, touch=not options.fake_run)
+        if options.verbose and prepared_data is not None:
+            print "Using cached image %s" % cache_key
+
+    if options.type.upper() in IMAGE_DECODERS:
+        if prepared_data is None:
+            try:
+                programmer_data = decode_image(options, programmer_data)
+            except ValueError as e:
+                parser.error('%s' % e) # app terminates
+        options.type = 'B'
+
+    if not options.manual_mode and prepared_data is None:
         autodetect_options(options, programmer_data)
 
     error = mandatory_option_check(options)
@@ -233,42 +477,174 @@ def main():
     programmer_data_length = len(programmer_data)
 
     # ----- Act with pjet -----
-    pjet_options = get_pjet_options(options, programmer_data_length) + " /dev/stdin"
-    if not options.verbose:
-        pjet_options += " > /dev/null"
-    if options.pjet_command:
-        command = "%s %s" % (options.pjet_command, pjet_options)
-    else:
-        command = "pjet %s" % pjet_options
+    devices = [ None ]
+    if options.device == 'all':
+        devices = find_promjet_devices()
+        if not devices:
+            parser.error('no Promjet devices found by lsusb') # app terminates
+    elif options.device:
+        devices = parse_device_list(options.device)
+    commands = [ (device, get_pjet_command(options, programmer_data_length, device)) for device in devices ]
 
     # Do this now so users can see warnings about the process if they're using
     # pjet or not
-    if not options.no_padding:
-        programmer_data = modify_data_for_programmer(options, programmer_data)
+    image_length, padding_length = programmer_data_length, 0
+    if prepared_data is not None:
+        programmer_data = prepared_data
+        image_length = len(programmer_data)
+    elif not options.no_padding:
+        image_length, padding_length = programmer_layout(options, programmer_data_length)
 
 
     # We may just want to print what would happen and stop
     if options.fake_run:
-        print command
+        for device, command in commands:
+            print command
         sys.exit(0)
 
     if options.verbose:
-        print command
+        for device, command in commands:
+            print command
+
+    if cache is not None and prepared_data is None:
+        programmer_data = cache.store(cache_key, options, programmer_data, image_length, padding_length,
+                                      int(options.fill, 16))
+        image_length, padding_length = len(programmer_data), 0
+        if options.verbose:
+            print "Cached prepared image %s" % cache_key
 
     # Send data to the Promjet via the pjet command.  Work around all its bugs
     # and cryptic control.
-    try:
-        pjet_handle = os.popen(command, "w")
-        pjet_handle.write(programmer_data)
-        pjet_handle.close()
-    except:
-        sys.stderr.write("Could not write image to promjet\n")
+    padding_byte = 0
+    if padding_length:
+        padding_byte = int(options.fill, 16)
+    # Without -d there is one device and pjet picks it; a device list always
+    # gets the per device report, even when it names just one
+    if not options.device:
+        status, seconds, error = burn_device(commands[0][1], programmer_data, image_length, padding_length,
+                                             padding_byte)
+        if error:
+            sys.stderr.write("Could not write image to promjet\n")
+            sys.exit(-1)
+        if status != 0:
+            sys.stderr.write("Error: pjet exited with status %s\n" % status)
+            sys.exit(-1)
+        return
+
+    results = burn_devices(commands, programmer_data, image_length, padding_length, padding_byte, options.jobs)
+    if not report_burn_results(results):
         sys.exit(-1)
 
 
 
 # --------------- Helpers ---------------
 
+def burn_device(command, data, image_len, padding_len, padding_byte):
+    """
+    Run one pjet command and stream the image into it.  Return pjet's exit
+    status (None if it couldn't be started), the seconds taken and an error
+    string if the image couldn't be written.
+    """
+    start = time.time()
+    try:
+        # close_fds so a pjet never holds another device's pipe open
+        pjet = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, close_fds=True)
+    except OSError as e:
+        return None, time.time() - start, str(e)
+    error = None
+    try:
+        write_programmer_data(pjet.stdin, data, image_len, padding_len, padding_byte)
+        pjet.stdin.close()
+    except EnvironmentError as e:
+        error = str(e)
+        try:
+            pjet.stdin.close()
+        except EnvironmentError:
+            pass
+    status = pjet.wait()
+    return status, time.time() - start, error
+
+
+def burn_devices(commands, data, image_len, padding_len, padding_byte, jobs):
+    """
+    Burn the same image with each (device, command) pair, running at most jobs
+    pjet processes at once.  Return (device, exit status, seconds, error) for
+    each device in the order given.
+    """
+    work = Queue.Queue()
+    for device, command in commands:
+        work.put((device, command))
+    results = {}
+
+    def worker():
+        while True:
+            try:
+                device, command = work.get_nowait()
+            except Queue.Empty:
+                return
+            results[device] = burn_device(command, data, image_len, padding_len, padding_byte)
+
+    workers = [ threading.Thread(target=worker) for i in range(max(1, min(jobs, len(commands)))) ]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return [ (device,) + results[device] for device, command in commands ]
+
+
+def report_burn_results(results):
+    """
+    Print a line per device from burn_devices().  Return True if every device
+    burned.
+    """
+    print "%6s  %-6s  %4s  %8s  %s" % ('Device', 'Result', 'Exit', 'Seconds', 'Error')
+    burned = 0
+    for device, status, seconds, error in results:
+        ok = status == 0 and not error
+        if ok:
+            burned += 1
+        if status is None:
+            exit_text = '-'
+        else:
+            exit_text = str(status)
+        print ("%6s  %-6s  %4s  %8.2f  %s" % (device, ok and 'ok' or 'FAILED', exit_text, seconds, error or '')).rstrip()
+    print "%d of %d devices burned" % (burned, len(results))
+    return burned == len(results)
+
+
+def parse_device_list(device_spec):
+    """
+    Turn a device list like 2, 1,3 or 1,5-8 into a sorted list of device
+    numbers.  Raise ValueError for anything else.
+    """
+    devices = set()
+    for part in device_spec.split(','):
+        first, dash, last = part.partition('-')
+        first = int(first)
+        if dash:
+            last = int(last)
+        else:
+            last = first
+        if first < 1 or last < first:
+            raise ValueError, "invalid device range %s" % part
+        devices.update(range(first, last + 1))
+    return sorted(devices)
+
+
+def find_promjet_devices():
+    """
+    Number the Promjets lsusb shows, 1 to n.  pjet numbers devices in the same
+    order.
+    """
+    try:
+        lsusb = subprocess.Popen(['lsusb'], stdout=subprocess.PIPE)
+        output = lsusb.communicate()[0]
+    except OSError:
+        return []
+    count = len([line for line in output.splitlines() if PROMJET_USB_PATTERN.search(line)])
+    return range(1, count + 1)
+
+
 def sorted_device_size_lists():
     """
     Return sorted device size lists in byte and metric representation
@@ -301,20 +677,220 @@ def sorted_metric_device_sizes():
     return metric_list
 
 
-def get_input_file_data(filename):
+def get_input_file_data(filename, max_buffer_len=None):
     """
-    Read a file or stdin into a string buffer and return it.  Limit host memory
-    use to maximum promjet device size.
+    Map a file or stdin read-only into memory and return the mapping.  Pipes
+    are spooled to a temporary file first since they can't be mapped.  Limit
+    the mapping to max_buffer_len bytes, by default the maximum promjet device
+    size.  An empty input gives an empty string.
     """
     if filename == '-':
         filename = '/dev/stdin'
 
+    # Allow one byte more than the biggest device so later code can truncate
+    if max_buffer_len is None:
+        max_buffer_len = number_with_metric_suffix_to_val(max_device_size()) + 1
     handle = open(filename, "rb")
-    # Limit host memory use, but allow trancations in later code
-    max_buffer_len = number_with_metric_suffix_to_val(max_device_size()) + 1
-    data = handle.read(max_buffer_len)
+    try:
+        if not stat.S_ISREG(os.fstat(handle.fileno()).st_mode):
+            handle = spool_to_temp_file(handle, max_buffer_len)
+        return map_file(handle, max_buffer_len)
+    finally:
+        handle.close()
+
+
+def map_file(handle, max_len):
+    """ Map up to max_len bytes of an open file read-only, or '' if it's empty """
+    data_length = min(os.fstat(handle.fileno()).st_size, max_len)
+    if data_length == 0:
+        return ''
+    return mmap.mmap(handle.fileno(), data_length, access=mmap.ACCESS_READ)
+
+
+def spool_to_temp_file(handle, max_len):
+    """
+    Copy up to max_len bytes from handle to an unlinked temporary file, a chunk
+    at a time.  Closes handle and returns the temporary file.
+    """
+    spool = tempfile.TemporaryFile()
+    remaining = max_len
+    while remaining > 0:
+        chunk = handle.read(min(STREAM_CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        spool.write(chunk)
+        remaining -= len(chunk)
     handle.close()
-    return data
+    spool.flush()
+    return spool
+
+
+def decode_image(options, data):
+    """
+    Decode Intel HEX or Motorola S-record text into a binary image and return
+    it mapped like any other input.  The image starts at the lowest address in
+    the text and gaps between records hold the fill byte.  Raise ValueError for
+    input that isn't valid or won't fit the largest device.
+    """
+    image_type = options.type.upper()
+    runs = IMAGE_DECODERS[image_type](data)
+    if not runs:
+        raise ValueError, "no data records in %s image" % IMAGE_TYPES[image_type]
+
+    base = min([start for start, end, blocks, records in runs])
+    image_len = max([end for start, end, blocks, records in runs]) - base
+    max_len = number_with_metric_suffix_to_val(max_device_size()) + 1
+    if image_len > max_len:
+        raise ValueError, "%s image spans %d bytes from address 0x%X, more than the largest device" % \
+              (IMAGE_TYPES[image_type], image_len, base)
+
+    # Fill the whole image first, then lay each run over the gaps
+    spool = tempfile.TemporaryFile()
+    try:
+        write_programmer_data(spool, '', 0, image_len, int(options.fill, 16))
+        for start, end, blocks, records in runs:
+            spool.seek(start - base)
+            for block in blocks:
+                spool.write(block)
+            spool.write(''.join(records))
+        spool.flush()
+        image = map_file(spool, image_len)
+    finally:
+        spool.close()
+
+    if options.verbose:
+        print "Decoded %d byte %s image starting at address 0x%X" % (image_len, IMAGE_TYPES[image_type], base)
+    return image
+
+
+def add_to_runs(runs, address, data):
+    """
+    Add the data of one record to runs, a list of [start, end, blocks, records]
+    for contiguous address ranges.  Data that continues the last run is appended
+    to it, and every RUN_BLOCK_RECORDS records are joined into one block.
+    """
+    if runs and runs[-1][1] == address:
+        run = runs[-1]
+        run[1] += len(data)
+        run[3].append(data)
+        if len(run[3]) >= RUN_BLOCK_RECORDS:
+            run[2].append(''.join(run[3]))
+            run[3] = []
+    else:
+        runs.append([address, address + len(data), [], [data]])
+
+
+def text_blocks(data):
+    """
+    Yield data in pieces of about DECODE_BLOCK_LEN bytes that end on a line
+    break, so no record is split between two of them.
+    """
+    start = 0
+    while start < len(data):
+        end = start + DECODE_BLOCK_LEN
+        if end < len(data):
+            newline = data.find('\n', end)
+            if newline < 0:
+                end = len(data)
+            else:
+                end = newline + 1
+        yield data[start:end]
+        start = end
+
+
+def decode_intel_hex(data):
+    """
+    Return the data of Intel HEX text as runs (see add_to_runs).  Each block of
+    text is unhexlified with one call once the ':' marks and line breaks are
+    gone, then the records are walked by their length bytes and checked against
+    their checksums and the number of ':' marks.  Extended segment and linear
+    address records move the base address; start address records are ignored.
+    """
+    runs = []
+    base = 0
+    number = 0
+    for block in text_blocks(data):
+        try:
+            raw = binascii.unhexlify(block.translate(None, ':' + TEXT_WHITESPACE))
+        except TypeError:
+            raise ValueError, "Intel HEX record %d or one after it has bad hex digits" % (number + 1)
+
+        first = number
+        position = 0
+        while position < len(raw):
+            number += 1
+            if len(raw) - position < 5:
+                raise ValueError, "Intel HEX record %d: wrong length" % number
+            count, offset, record_type = struct.unpack_from('>BHB', raw, position)
+            end = position + count + 5
+            if end > len(raw):
+                raise ValueError, "Intel HEX record %d: wrong length" % number
+            if sum(bytearray(raw[position:end])) & 0xFF:
+                raise ValueError, "Intel HEX record %d: bad checksum" % number
+
+            if record_type == 0:
+                add_to_runs(runs, base + offset, raw[position + 4:end - 1])
+            elif record_type == 1:
+                return runs
+            elif record_type == 2:
+                base = struct.unpack_from('>H', raw, position + 4)[0] << 4
+            elif record_type == 4:
+                base = struct.unpack_from('>H', raw, position + 4)[0] << 16
+            position = end
+
+        if number - first != block.count(':'):
+            raise ValueError, "Intel HEX records %d to %d don't match their ':' marks" % (first + 1, number)
+    return runs
+
+
+def decode_srecord(data):
+    """
+    Return the data of Motorola S-record text as runs (see add_to_runs).  The
+    'S' and type digit of every record in a block are pulled out with one regex
+    and the rest is unhexlified with one call, then the records are walked by
+    their length bytes and checked against their checksums.  Only S1, S2 and S3
+    records carry data; S7, S8 and S9 end it.
+    """
+    runs = []
+    number = 0
+    for block in text_blocks(data):
+        record_types = SRECORD_START.findall(block)
+        try:
+            raw = binascii.unhexlify(SRECORD_START.sub('', block).translate(None, TEXT_WHITESPACE))
+        except TypeError:
+            raise ValueError, "S-record %d or one after it has bad hex digits" % (number + 1)
+
+        position = 0
+        for record_type in record_types:
+            number += 1
+            address_len = SRECORD_ADDRESS_BYTES.get(record_type, 0)
+            if position == len(raw):
+                raise ValueError, "S-record %d: missing" % number
+            end = position + ord(raw[position]) + 1
+            if end > len(raw) or end - position < address_len + 2:
+                raise ValueError, "S-record %d: wrong length" % number
+            if sum(bytearray(raw[position:end])) & 0xFF != 0xFF:
+                raise ValueError, "S-record %d: bad checksum" % number
+
+            if address_len:
+                if address_len == 4:
+                    address = struct.unpack_from('>I', raw, position + 1)[0]
+                elif address_len == 2:
+                    address = struct.unpack_from('>H', raw, position + 1)[0]
+                else:
+                    address = ord(raw[position + 1]) << 16 | struct.unpack_from('>H', raw, position + 2)[0]
+                add_to_runs(runs, address, raw[position + 1 + address_len:end - 1])
+            elif record_type in '789':
+                return runs
+            position = end
+
+        if position != len(raw):
+            raise ValueError, "S-record %d: extra data after it" % number
+    return runs
+
+
+IMAGE_DECODERS = { 'I' : decode_intel_hex,
+                   'M' : decode_srecord }
 
 
 def number_with_metric_suffix_to_val(number_str):
@@ -355,20 +931,38 @@ def device_spec_to_num_bytes(num_mem_locations, width):
     return num_bytes
 
 
-def pad_data_to_size(data, num_bytes, padding_byte):
+def write_programmer_data(handle, data, image_len, padding_len, padding_byte):
     """
-    Increase data buffer to specified number of bytes using the padding_byte.
-    If the incoming data is larger than the device size already, just return
-    what was passed in.
+    Write the first image_len bytes of data and then padding_len copies of
+    padding_byte to handle, STREAM_CHUNK_SIZE bytes at a time.  The image goes
+    out as buffer views of data so it is never copied; one chunk of fill is
+    built and reused.
     """
-    padding_len = num_bytes - len(data)
-    if padding_len < 1:
-        return data
-    data_out = data + str(('%c' % padding_byte) * padding_len)
-    return data_out
+    for offset in xrange(0, image_len, STREAM_CHUNK_SIZE):
+        handle.write(buffer(data, offset, min(STREAM_CHUNK_SIZE, image_len - offset)))
+
+    fill_chunk = chr(padding_byte) * min(STREAM_CHUNK_SIZE, padding_len)
+    while padding_len > 0:
+        if padding_len < len(fill_chunk):
+            fill_chunk = fill_chunk[:padding_len]
+        handle.write(fill_chunk)
+        padding_len -= len(fill_chunk)
+
+
+def get_pjet_command(options, data_length, device=None):
+    """
+    Build the shell command that runs pjet for one device, reading the image
+    from stdin.
+    """
+    pjet_options = get_pjet_options(options, data_length, device) + " /dev/stdin"
+    if not options.verbose:
+        pjet_options += " > /dev/null"
+    if options.pjet_command:
+        return "%s %s" % (options.pjet_command, pjet_options)
+    return "pjet %s" % pjet_options
 
 
-def get_pjet_options(options, data_length):
+def get_pjet_options(options, data_length, device=None):
     """
     Take command line options that have _already_ been sanity checked and turn
     them into an option string for the pjet command.  Use environment variables
@@ -403,8 +997,8 @@ def get_pjet_options(options, data_length):
     else:
         pjet_options = pjet_options + (" L=%X" % data_length)
 
-    if options.device:
-        pjet_options = pjet_options + (" X=%s" % options.device)
+    if device:
+        pjet_options = pjet_options + (" X=%s" % device)
 
     return pjet_options
 
@@ -418,14 +1012,19 @@ def basic_option_check(options):
         return "device size %s is invalid. (%s)" % (options.size.upper(), ", ".join(sorted_metric_device_sizes()))
     if options.width and not options.width in DEVICE_WIDTHS:
         return "device width %s is invalid (%s)" % (options.width, ", ".join(DEVICE_WIDTHS))
-    device_num = 0
-    if options.device:
+    try:
+        number_with_metric_suffix_to_val(options.cache_size)
+    except ValueError:
+        return "invalid cache size %s" % options.cache_size
+    if not options.type.upper() in IMAGE_TYPES:
+        return "image type %s is invalid (%s)" % (options.type, ", ".join(sorted(IMAGE_TYPES)))
+    if options.device and options.device != 'all':
         try:
-            device_num = int(options.device)
+            parse_device_list(options.device)
         except ValueError:
-            device_num = 0
-        if device_num < 1:
-            return "invalid device number %s.  Must be between 1 and n" % options.device
+            return "invalid device list %s.  Use device numbers between 1 and n, ranges like 1-4 or all" % options.device
+    if options.jobs < 1:
+        return "invalid number of jobs %d" % options.jobs
     return ""
 
 
@@ -465,6 +1064,9 @@ def detect_env_options(options):
             sys.stderr.write("Warning: %s of %s not a supported setting (%s)\n" %
                              (PJET_SIZE_ENV_VAR, env_size, ', '.join(sorted_metric_device_sizes())))
 
+    if not options.cache_dir:
+        options.cache_dir = os.getenv(PJET_CACHE_DIR_ENV_VAR)
+
     if not options.swap:
         env_swap = os.getenv(PJET_SWAP_ENV_VAR)
         if env_swap:
@@ -477,10 +1079,12 @@ def autodetect_find_platform(options, data):
     """
     Find platform spec by comparing filename and image data with platform name.
     """
-    for platform in PLATFORM_LIST:
-        binary_search = re.compile(b"SonicWALL,%s" % platform.name.capitalize())
-        if binary_search.search(data):
-            return platform
+    if options.verbose:
+        for offset, platform in PLATFORM_MATCHER.find_all(data):
+            print "Found SonicWALL,%s marker at offset 0x%X" % (platform.name.capitalize(), offset)
+    platform = PLATFORM_MATCHER.find(data)
+    if platform:
+        return platform
 
     for platform in PLATFORM_LIST:
         if os.path.basename(options.input_filename).lower().find(platform.name) >= 0:
@@ -548,25 +1152,24 @@ def autodetect_options(options, data):
         sys.stderr.write("Warning: unable to autosize from input file because we don't have a bus width\n")
 
 
-def modify_data_for_programmer(options, data):
+def programmer_layout(options, data_length):
     """
-    Perform truncation if needed, and then pad to promjet buffer size.  The pjet
-    command seems to have a much easier time reading files if the file is
-    exactly the size as the memory it's emulating.
+    Work out truncation and padding to the promjet buffer size without touching
+    the data.  The pjet command seems to have a much easier time reading files
+    if the file is exactly the size as the memory it's emulating.  Return the
+    number of image bytes to send and the number of fill bytes to follow them.
     """
     promjet_buffer_size = device_spec_to_num_bytes(options.size, options.width)
-    if len(data) > promjet_buffer_size:
+    image_len = data_length
+    if image_len > promjet_buffer_size:
         sys.stderr.write("Warning: input file larger than device - truncating data to fit\n")
         # TODO - test truncation to make sure it works
-        data = data[0:(promjet_buffer_size - 1)]
-
-    pre_padded_len = len(data)
-    data = pad_data_to_size(data, promjet_buffer_size, int(options.fill, 16))
-    padding_len = len(data) - pre_padded_len
+        image_len = promjet_buffer_size - 1
 
+    padding_len = max(0, promjet_buffer_size - image_len)
     if options.verbose and padding_len:
         print "Padding data with %d bytes of pattern %s." % (padding_len, options.fill)
-    return data
+    return image_len, padding_len
 
 
 def strtobool(str):
@@ -1,5 +1,6 @@
 #!/usr/bin/python
-import time,re,pycurl,BeautifulSoup,optparse
+import time,re,hashlib,threading
+import pwrlib
 
 ###############################################################
 # Digital Loggers Web Power Switch management
@@ -19,59 +20,198 @@ import time,re,pycurl,BeautifulSoup,optparse
 #            notice are included in full.
 ###############################################################
 
+# pycurl and BeautifulSoup are imported where they are used so that importing
+# this module (e.g. for a CLI command that never touches the network) is cheap
+
 # Global settings
-# Timeout in seconds
+# Timeout in seconds for a whole request
 TIMEOUT=5
+# Seconds to wait for a connection, and for a stalled transfer to resume
+CONNECT_TIMEOUT=2
+READ_TIMEOUT=3
+# Parse index.htm with the regex scanner, BeautifulSoup is the fallback
+FAST_PARSER=True
+# Stop downloading index.htm once the outlet table is complete.  Aborting a
+# transfer closes the connection, so this only pays off on slow switches
+STREAMING=False
+# index.htm layout: outlet table is the sixth table, rows start after 2 headers
+OUTLET_TABLE_INDEX=5
+OUTLET_HEADER_ROWS=2
+
+_TABLE_START=re.compile(r'<table\b',re.I)
+_TABLE_END=re.compile(r'</table\s*>',re.I)
+_ROW_START=re.compile(r'<tr\b',re.I)
+_CELL=re.compile(r'<td\b[^>]*>(.*?)</td\s*>',re.I|re.S)
+_FONT=re.compile(r'<font\b[^>]*>(.*?)</font\s*>',re.I|re.S)
+_TAG=re.compile(r'<[^>]*>')
+
+def _cell_text(cell):
+    return _TAG.sub('',cell).strip()
+
+def find_outlet_table(page):
+    """ Return the text of the outlet table on index.htm, or None """
+    start=None
+    for count,match in enumerate(_TABLE_START.finditer(page)):
+        if count == OUTLET_TABLE_INDEX:
+            start=match.end()
+            break
+    if start is None:
+        return None
+    end=_TABLE_END.search(page,start)
+    if not end:
+        return None
+    return page[start:end.start()]
+
+def parse_outlet_table(page,table=None):
+    """ Scan index.htm for the outlet table without building a document tree.
+    Returns the same [plugnumber, hostname, state] rows as the BeautifulSoup
+    parser, or None if the page doesn't have the expected layout.  Pass the
+    table if find_outlet_table() has already been called """
+    if table is None:
+        table=find_outlet_table(page)
+    if table is None:
+        return None
+    outlets=[]
+    for row in _ROW_START.split(table)[1+OUTLET_HEADER_ROWS:]:
+        columns=_CELL.findall(row)
+        if len(columns) < 3:
+            return None
+        state=_FONT.search(columns[2])
+        if not state:
+            return None
+        try:
+            plugnumber=int(_cell_text(columns[0]))
+        except ValueError:
+            return None
+        outlets.append([plugnumber,_cell_text(columns[1]),_cell_text(state.group(1))])
+    return outlets
+
+def parse_outlet_table_soup(page):
+    """ Original BeautifulSoup parser for index.htm, kept as the fallback """
+    import BeautifulSoup
+    outlets=[]
+    soup=BeautifulSoup.BeautifulSoup(page)
+    try:
+        powertable=soup.findAll('table')[OUTLET_TABLE_INDEX]
+    except IndexError:
+        return None
+    for temp in powertable.findAll('tr')[OUTLET_HEADER_ROWS:]:
+        columns=temp.findAll('td')
+        plugnumber=columns[0].string
+        hostname=columns[1].string
+        state=columns[2].find('font').string
+        outlets.append([int(plugnumber),hostname,state])
+    return outlets
 
 class powerswitch:
     """ Manage the DLI Web power switch """
-    def __init__(self,userid='admin',password='4321',hostname='192.168.0.100'):
+    # outlet?N=CCL power cycles using the cycle delay set on the switch
+    supports_cycle=True
+    def __init__(self,userid='admin',password='4321',hostname='192.168.0.100',pool=None,status_ttl=pwrlib.STATUS_TTL,
+                 streaming=STREAMING,connect_timeout=CONNECT_TIMEOUT,read_timeout=READ_TIMEOUT):
         self.userid=userid
         self.password=password
         self.hostname=hostname
         self.contents=''
+        self.chunks=[]
+        self.scanner=None
+        self.streaming=streaming
+        self.pool=pool or pwrlib.DEFAULT_POOL
+        self.status_cache=pwrlib.StatusCache(status_ttl)
+        self.stats=pwrlib.STATS
+        self.connect_timeout=connect_timeout
+        self.read_timeout=read_timeout
+        self.health=pwrlib.Health(hostname)
+        # geturl uses the chunk buffer, one request at a time
+        self.lock=threading.RLock()
     def verify(self):
-        """ Verify we can reach the switch, returns true if ok """
-        return self.geturl()
+        """ Verify we can reach the switch, returns true if ok.  Only opens a
+        connection, no page is fetched """
+        if pwrlib.probe(self.hostname,self.connect_timeout):
+            self.health.succeeded()
+            return True
+        self.health.failed('no connection')
+        return False
     def body_callback(self,buf):
-        self.contents=self.contents+buf
-    def geturl(self,url='index.htm') :
-        self.contents=''
-        curl = pycurl.Curl()
-        curl.setopt(curl.TIMEOUT,TIMEOUT)
-        curl.setopt(curl.URL, 'http://%s:%s@%s/%s' % (self.userid,self.password,self.hostname,url))
-        curl.setopt(curl.WRITEFUNCTION, self.body_callback)
-        try:
-            curl.perform()
-            curl.close()
-        except pycurl.error:
-            raise Exception("Could not login to DLI Powerstrip %s@%s" % (self.userid, self.hostname))
-            return None
-        return self.contents
+        self.chunks.append(buf)
+        if self.scanner and self.scanner.feed(buf):
+            return 0   # Outlet table is complete, abort the rest of the page
+    def geturl(self,url='index.htm',scanner=None,check_health=True) :
+        """ Fetch url from the switch.  With a scanner the transfer stops as
+        soon as the scanner has seen what it is looking for.  Outlet control
+        passes check_health=False so it is tried even while the switch is in
+        its cool-down, and only updates the health state """
+        import pycurl
+        with self.lock:
+            if check_health:
+                self.health.check()
+            self.chunks=[]
+            self.scanner=scanner
+            curl = self.pool.acquire(self.hostname)
+            pwrlib.set_timeouts(curl,self.connect_timeout,self.read_timeout,TIMEOUT)
+            curl.setopt(curl.URL, 'http://%s:%s@%s/%s' % (self.userid,self.password,self.hostname,url))
+            curl.setopt(curl.WRITEFUNCTION, self.body_callback)
+            try:
+                curl.perform()
+            except pycurl.error as e:
+                if not (scanner and scanner.done and e.args[0] == pycurl.E_WRITE_ERROR):
+                    self.stats.record_transfer(self.hostname, curl, error=True)
+                    self.pool.discard(curl)
+                    self.health.failed(e.args[-1])
+                    raise Exception("Could not login to DLI Powerstrip %s@%s" % (self.userid, self.hostname))
+                    return None
+            self.stats.record_transfer(self.hostname, curl)
+            self.health.succeeded()
+            self.pool.release(self.hostname, curl)
+            self.scanner=None
+            self.contents=''.join(self.chunks)
+            self.chunks=[]
+            return self.contents
     def off(self,outlet=0):
         """ Turn off a power to an outlet """
-        self.geturl(url= 'outlet?%d=OFF' % outlet)
+        self.geturl(url= 'outlet?%d=OFF' % outlet,check_health=False)
+        self.status_cache.update({outlet: 'OFF'})
     def on(self,outlet=0):
         """ Turn on power to an outlet """
-        self.geturl(url= 'outlet?%d=ON' % outlet)
+        self.geturl(url= 'outlet?%d=ON' % outlet,check_health=False)
+        self.status_cache.update({outlet: 'ON'})
+    def set_outlets(self,outlet_actions):
+        """ Apply a {outlet: action} map, action is 'ON', 'OFF' or 'CCL'.
+        The switch only takes one outlet per request, these go out in
+        port order over the same pooled connection """
+        for outlet in sorted(outlet_actions.keys()):
+            self.geturl(url= 'outlet?%d=%s' % (outlet,outlet_actions[outlet].upper()),check_health=False)
+        self.status_cache.update(outlet_actions)
     def statuslist(self):
         """ Return the status of all outlets in a list,
-        each item will contain 3 itmes plugnumber, hostname and state  """
-        outlets=[]
-        url=self.geturl('index.htm')
+        each item will contain 3 itmes plugnumber, hostname and state.
+        The list is reused for status_cache.ttl seconds after a fetch, and
+        the page isn't parsed again if its outlet table hasn't changed """
+        outlets=self.status_cache.get()
+        if outlets:
+            return outlets
+        scanner=None
+        if self.streaming:
+            scanner=pwrlib.TableScanner(_TABLE_START,OUTLET_TABLE_INDEX)
+        url=self.geturl('index.htm',scanner)
         if not url:
             return None
-        soup=BeautifulSoup.BeautifulSoup(url)
-        try:
-            powertable=soup.findAll('table')[5]
-        except IndexError:
+        if scanner and scanner.done:
+            table=scanner.inner
+        else:
+            table=find_outlet_table(url)
+        digest=hashlib.md5(table or url).digest()
+        outlets=self.status_cache.match(digest)
+        if outlets:
+            return outlets
+        with self.stats.timer(self.hostname,'parse'):
+            if FAST_PARSER and table is not None:
+                outlets=parse_outlet_table(url,table)
+            if outlets is None:
+                outlets=parse_outlet_table_soup(url)
+        if outlets is None:
             return None
-        for temp in powertable.findAll('tr')[2:]:
-            columns=temp.findAll('td')
-            plugnumber=columns[0].string
-            hostname=columns[1].string
-            state=columns[2].find('font').string
-            outlets.append([int(plugnumber),hostname,state])
+        self.status_cache.put(outlets,digest)
         return outlets
     def printstatus(self):
         """ Print the status off all the outlets as a table to stdout """
@@ -103,9 +243,24 @@ class DliPowerSwitch(powerswitch):
     Also rename class interface to conform to Python naming convention so it
     matches the rest of our code.
     """
-    def __init__(self, userid='admin', password='4321', hostname='192.168.0.100', num_ports=8):
+    def __init__(self, userid='admin', password='4321', hostname='192.168.0.100', num_ports=8, pool=None,
+                 status_ttl=pwrlib.STATUS_TTL, streaming=STREAMING, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT):
         self.num_ports = num_ports
-        powerswitch.__init__(self, userid, password, hostname)
+        powerswitch.__init__(self, userid, password, hostname, pool, status_ttl, streaming, connect_timeout,
+                             read_timeout)
+
+    def set_outlets(self, outlet_actions):
+        """
+        Same as the base class, but when every port gets the same action use
+        the switch's all-outlets request instead of one request per port.
+        """
+        actions = set([action.upper() for action in outlet_actions.values()])
+        if len(actions) == 1 and sorted(outlet_actions.keys()) == range(1, self.num_ports + 1):
+            self.geturl(url='outlet?a=%s' % actions.pop(), check_health=False)
+            self.status_cache.update(outlet_actions)
+            return
+        powerswitch.set_outlets(self, outlet_actions)
 
     def status_list(self):
         return self.statuslist()
@@ -119,6 +274,7 @@ class DliPowerSwitch(powerswitch):
 
 
 if __name__ == "__main__":
+    import optparse
     parser = optparse.OptionParser()
     parser.add_option('--hostname',dest='hostname',default="10.0.54.120")
     parser.add_option('--user',    dest='user',    default="admin")
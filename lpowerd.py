@@ -0,0 +1,237 @@
+"""
+Description: Unix socket server and client for a long running lpower process
+
+Every lpower command pays for a fresh interpreter, the driver imports, loading
+settings and new connections to the strips.  A daemon keeps all of that warm:
+it owns one VirtualPowerSwitch and answers command lines sent to it over a
+local Unix socket.  The CLI tries the daemon first and falls back to running
+the command itself when nothing is listening.
+
+The protocol is one JSON object per line in each direction.  The daemon greets
+every connection first; a client that isn't greeted within CONNECT_TIMEOUT
+hangs up without sending anything, so a wedged daemon can't have run the
+command and the CLI runs it itself:
+
+    greeting: {"ready": true}
+    request:  {"argv": ["on", "3"]}   or   {"shutdown": true}
+    reply:    {"exit": 0, "stdout": "...", "stderr": "..."}
+
+Each request runs in its own thread with its own captured output, so a slow
+reset doesn't hold up other clients.
+
+The module doesn't know about lpower commands; the caller hands serve() a
+function that runs one argv list and returns its exit code.
+"""
+
+import os
+import sys
+import json
+import socket
+import threading
+import StringIO
+
+
+
+# Seconds to wait for the daemon's greeting before running the command locally
+CONNECT_TIMEOUT = 2
+# Seconds to wait for a command's reply.  Long enough for a reset with a long
+# delay; past it the command may have run, so the client gives up with an error
+REQUEST_TIMEOUT = 300
+
+_INSTALL_LOCK = threading.Lock()
+
+
+
+class _ThreadOutput(object):
+    """
+    Stand-in for sys.stdout or sys.stderr that sends each thread's output to
+    the buffer it is capturing into, or to the real stream if it isn't.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def _target(self):
+        return getattr(self.local, 'buffer', None) or self.stream
+
+    # print keeps its state in softspace, which has to follow the target
+    def _get_softspace(self):
+        return getattr(self._target(), 'softspace', 0)
+
+    def _set_softspace(self, value):
+        self._target().softspace = value
+
+    softspace = property(_get_softspace, _set_softspace)
+
+    def write(self, text):
+        self._target().write(text)
+
+    def writelines(self, lines):
+        self._target().writelines(lines)
+
+    def flush(self):
+        self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+
+def _install_thread_output():
+    """ Put _ThreadOutput in front of sys.stdout and sys.stderr, once """
+    with _INSTALL_LOCK:
+        if not isinstance(sys.stdout, _ThreadOutput):
+            sys.stdout = _ThreadOutput(sys.stdout)
+        if not isinstance(sys.stderr, _ThreadOutput):
+            sys.stderr = _ThreadOutput(sys.stderr)
+
+
+def run_captured(func, *args):
+    """
+    Call func(*args) with this thread's stdout and stderr captured.  Returns
+    (exit code, stdout text, stderr text); SystemExit raised by func becomes
+    the exit code.  Other threads can run commands at the same time.
+    """
+    _install_thread_output()
+    out, err = StringIO.StringIO(), StringIO.StringIO()
+    sys.stdout.local.buffer, sys.stderr.local.buffer = out, err
+    try:
+        try:
+            code = func(*args)
+        except SystemExit as e:
+            code = e.code
+        except Exception as e:
+            sys.stderr.write("%s\n" % str(e))
+            code = -1
+        return code or 0, _text(out.getvalue()), _text(err.getvalue())
+    finally:
+        sys.stdout.local.buffer = sys.stderr.local.buffer = None
+
+
+def _text(output):
+    """ Captured output as unicode so it survives the JSON round trip """
+    if isinstance(output, unicode):
+        return output
+    return output.decode('utf-8', 'replace')
+
+
+def _server_class():
+    """
+    Build the server classes on first use.  SocketServer is only needed by the
+    daemon, not by the client side that runs on every command.
+    """
+    import SocketServer
+
+    class RequestHandler(SocketServer.StreamRequestHandler):
+        """ Greet the client, read one request line, run it and write one reply line """
+        def handle(self):
+            self.wfile.write(json.dumps({ 'ready' : True }) + '\n')
+            try:
+                request = json.loads(self.rfile.readline())
+            except ValueError:
+                return
+            if request.get('shutdown'):
+                self.wfile.write(json.dumps({ 'exit' : 0, 'stdout' : '', 'stderr' : '' }) + '\n')
+                threading.Thread(target=self.server.shutdown).start()
+                return
+            argv = [arg.encode('utf-8') for arg in request.get('argv', [])]
+            code, out, err = run_captured(self.server.command_handler, argv)
+            self.wfile.write(json.dumps({ 'exit' : code, 'stdout' : out, 'stderr' : err }) + '\n')
+
+    class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+        daemon_threads = True
+        def __init__(self, socket_path):
+            SocketServer.UnixStreamServer.__init__(self, socket_path, RequestHandler)
+
+    return Server
+
+
+def serve(socket_path, command_handler):
+    """
+    Listen on socket_path until a shutdown request arrives.  command_handler is
+    called with an argv list (without the program name) and returns an exit
+    code.  A stale socket left by a dead daemon is replaced; a live one is an
+    error.
+    """
+    if request(socket_path, None) is not None:
+        raise Exception("lpowerd is already running on %s" % socket_path)
+    server_class = _server_class()
+    try:
+        os.remove(socket_path)
+    except OSError:
+        pass
+    old_umask = os.umask(0177)
+    try:
+        server = server_class(socket_path)
+    finally:
+        os.umask(old_umask)
+    server.command_handler = command_handler
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        try:
+            os.remove(socket_path)
+        except OSError:
+            pass
+
+
+def _connect(socket_path, connect_timeout):
+    """
+    Connect to the daemon and wait for its greeting.  Returns (socket, reader)
+    or None if nothing answered in time.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(connect_timeout)
+    try:
+        client.connect(socket_path)
+        reader = client.makefile('r')
+        greeting = json.loads(reader.readline())
+    except (socket.error, ValueError):
+        client.close()
+        return None
+    if not greeting.get('ready'):
+        client.close()
+        return None
+    return client, reader
+
+
+def request(socket_path, argv, connect_timeout=CONNECT_TIMEOUT, timeout=REQUEST_TIMEOUT):
+    """
+    Send argv to the daemon on socket_path and return (exit code, stdout,
+    stderr).  argv of None only checks that a daemon answers.  Returns None if
+    no daemon greeted us within connect_timeout, in which case nothing was
+    sent.  Raises an Exception if the reply doesn't come within timeout.
+    """
+    connection = _connect(socket_path, connect_timeout)
+    if connection is None:
+        return None
+    client, reader = connection
+    try:
+        if argv is None:
+            return (0, '', '')
+        client.settimeout(timeout)
+        try:
+            client.sendall(json.dumps({ 'argv' : argv }) + '\n')
+            reply = json.loads(reader.readline())
+        except (socket.error, ValueError):
+            raise Exception("lpowerd on %s didn't answer within %d seconds; the command may or may not "
+                            "have run" % (socket_path, timeout))
+    finally:
+        client.close()
+    return reply['exit'], reply['stdout'].encode('utf-8'), reply['stderr'].encode('utf-8')
+
+
+def shutdown(socket_path, connect_timeout=CONNECT_TIMEOUT):
+    """ Ask the daemon on socket_path to exit.  Returns False if none answered """
+    connection = _connect(socket_path, connect_timeout)
+    if connection is None:
+        return False
+    client, reader = connection
+    try:
+        client.sendall(json.dumps({ 'shutdown' : True }) + '\n')
+        reader.readline()
+    except socket.error:
+        return False
+    finally:
+        client.close()
+    return True
@@ -0,0 +1,680 @@
+"""
+Description: Non-blocking power switch drivers driven from one event loop
+
+The dli, stech and vswitch classes block, so driving a large fleet with them
+takes a thread per strip.  The classes here have the same surface (on, off,
+set_outlets, status_list, status and verify) but each call returns a Future
+right away.  Every request goes through one Loop, which runs them all on a
+single pycurl CurlMulti handle, so hundreds of strips can be driven from one
+thread.  The loop caps how many transfers are in flight in total and per
+strip; requests over the cap wait in line.  Connect and read timeouts and
+health tracking work as in the blocking drivers: status reads from a strip that
+is down fail at once and the virtual switch reports its ports as Unknown, while
+outlet control is always tried.
+
+Operations are written as generator coroutines: they yield Futures (or lists
+of Futures to wait on all of them) and get the result back from the yield.
+Python 2 generators can't return a value, so a coroutine finishes with
+raise Return(value).
+
+    loop = pwrasync.Loop(max_connections=64)
+    rack = pwrasync.build_switch(loop, *vswitch.read_config('rack.conf'))
+    print loop.run(rack.status_list())
+    loop.run([rack.on(3), rack.off(12)])
+"""
+
+import os
+import sys
+import time
+import base64
+import hashlib
+import heapq
+import pwrlib
+import dli
+import stech
+
+
+
+# Global settings
+# Transfers in flight at once, over all strips
+MAX_CONNECTIONS = 64
+# Transfers in flight at once to one strip; small embedded web servers don't
+# do well with more
+MAX_PER_HOST = 2
+
+
+
+class Return(Exception):
+    """ Raised by a coroutine to finish with a value """
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+
+
+class Future:
+    """ The eventual result of an operation """
+    def __init__(self):
+        self.callbacks = []
+        self._done = False
+        self._result = None
+        self.exc_info = None
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        """ The result, or raise the exception the operation failed with """
+        if not self._done:
+            raise Exception("Operation has not finished")
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self._result
+
+    def add_done_callback(self, callback):
+        """ Call callback(future) when done, or now if it already is """
+        if self._done:
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exc_info):
+        """ Fail with an exception, given as a sys.exc_info() tuple """
+        self.exc_info = exc_info
+        self._finish()
+
+    def _finish(self):
+        self._done = True
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+
+class Task(Future):
+    """ A Future for a running generator coroutine """
+    def __init__(self, loop, generator):
+        Future.__init__(self)
+        self.loop = loop
+        self.generator = generator
+        self._step(None, None)
+
+    def _step(self, value, exc_info):
+        try:
+            if exc_info:
+                yielded = self.generator.throw(*exc_info)
+            else:
+                yielded = self.generator.send(value)
+        except Return as e:
+            self.set_result(e.value)
+            return
+        except StopIteration:
+            self.set_result(None)
+            return
+        except Exception:
+            self.set_exception(sys.exc_info())
+            return
+        try:
+            future = self.loop.future(yielded)
+        except Exception:
+            self.loop.call_soon(self._step, None, sys.exc_info())
+            return
+        future.add_done_callback(self._wakeup)
+
+    def _wakeup(self, future):
+        if future.exc_info:
+            self._step(None, future.exc_info)
+        else:
+            self._step(future._result, None)
+
+
+
+class Response:
+    """ A finished HTTP transfer """
+    def __init__(self, code, body, headers, redirect_url):
+        self.code = code
+        self.body = body
+        self.headers = headers
+        self.redirect_url = redirect_url or ''
+
+    def cookies(self):
+        """ name=value of every Set-Cookie header """
+        cookies = []
+        for line in self.headers:
+            if line.lower().startswith('set-cookie:'):
+                cookies.append(line.split(':', 1)[1].split(';', 1)[0].strip())
+        return cookies
+
+
+
+class _Request:
+    def __init__(self, host, url, headers, post_fields, timeouts, connect_only=False):
+        self.host = host
+        self.url = url
+        self.headers = headers
+        self.post_fields = post_fields
+        self.timeouts = timeouts
+        self.connect_only = connect_only
+        self.future = Future()
+        self.chunks = []
+        self.response_headers = []
+
+
+
+class Loop:
+    """
+    Event loop that runs HTTP transfers on one CurlMulti handle.  At most
+    max_connections transfers run at once, and at most max_per_host to one
+    host; the rest wait in the order they were asked for.  Finished handles
+    stay with the loop so later requests to the same strip reuse the open
+    connection.
+    """
+    def __init__(self, max_connections=MAX_CONNECTIONS, max_per_host=MAX_PER_HOST, stats=None):
+        import pycurl
+        self.pycurl = pycurl
+        self.multi = pycurl.CurlMulti()
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.stats = stats or pwrlib.STATS
+        self.queue = []
+        self.active = {}
+        self.per_host = {}
+        self.idle = []
+        self.ready = []
+        self.timers = []
+        self.timer_count = 0
+
+    def fetch(self, host, url, headers=None, post_fields=None, timeout=dli.TIMEOUT,
+              connect_timeout=dli.CONNECT_TIMEOUT, read_timeout=dli.READ_TIMEOUT):
+        """ Start a request for http://host/url, returns a Future for its Response """
+        request = _Request(host, url, headers or [], post_fields, (connect_timeout, read_timeout, timeout))
+        self.queue.append(request)
+        return request.future
+
+    def probe(self, host, timeout=pwrlib.PROBE_TIMEOUT):
+        """ Future that is true if host accepts a connection; nothing is sent """
+        request = _Request(host, '', [], None, (timeout, timeout, timeout), connect_only=True)
+        self.queue.append(request)
+        probed = Future()
+        def finished(future):
+            probed.set_result(not future.exc_info)
+        request.future.add_done_callback(finished)
+        return probed
+
+    def spawn(self, generator):
+        """ Start a coroutine, returns its Task """
+        return Task(self, generator)
+
+    def sleep(self, seconds):
+        """ Returns a Future that completes after seconds """
+        future = Future()
+        self.call_later(seconds, future.set_result, None)
+        return future
+
+    def call_soon(self, func, *args):
+        self.ready.append((func, args))
+
+    def call_later(self, seconds, func, *args):
+        self.timer_count += 1
+        heapq.heappush(self.timers, (time.time() + seconds, self.timer_count, func, args))
+
+    def gather(self, futures):
+        """
+        A Future for the results of every Future in the list, in order.  It
+        waits for all of them; if any failed, the first failure is raised.
+        """
+        futures = [self.future(future) for future in futures]
+        gathered = Future()
+        if not futures:
+            gathered.set_result([])
+            return gathered
+        remaining = [len(futures)]
+        def finished(future):
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+            for future in futures:
+                if future.exc_info:
+                    gathered.set_exception(future.exc_info)
+                    return
+            gathered.set_result([future._result for future in futures])
+        for future in futures:
+            future.add_done_callback(finished)
+        return gathered
+
+    def future(self, value):
+        """ A Future for value: a Future, a coroutine or a list of either """
+        if isinstance(value, Future):
+            return value
+        if isinstance(value, (list, tuple)):
+            return self.gather(value)
+        if hasattr(value, 'send') and hasattr(value, 'throw'):
+            return self.spawn(value)
+        raise Exception("Can't wait on %r" % (value,))
+
+    def run(self, value):
+        """ Run the loop until value (see future()) is done and return its result """
+        future = self.future(value)
+        while not future.done():
+            if not (self.ready or self.timers or self.queue or self.active):
+                raise Exception("Nothing left to wait for")
+            self._run_once()
+        return future.result()
+
+    def close(self):
+        for curl in self.idle:
+            curl.close()
+        self.idle = []
+        self.multi.close()
+
+    def _run_once(self):
+        while self.ready:
+            func, args = self.ready.pop(0)
+            func(*args)
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            deadline, count, func, args = heapq.heappop(self.timers)
+            func(*args)
+        self._start_queued()
+        if self.active:
+            while True:
+                status, num_handles = self.multi.perform()
+                if status != self.pycurl.E_CALL_MULTI_PERFORM:
+                    break
+            self._collect()
+            # Finished transfers free slots for requests that were waiting
+            self._start_queued()
+        if self.ready:
+            return
+        timeout = 1.0
+        if self.timers:
+            timeout = min(timeout, max(self.timers[0][0] - time.time(), 0))
+        if self.active:
+            if self.multi.select(timeout) < 0:
+                # No sockets yet (e.g. still resolving); don't spin
+                time.sleep(min(timeout, 0.001))
+        elif self.timers:
+            time.sleep(timeout)
+
+    def _start_queued(self):
+        waiting = []
+        for request in self.queue:
+            if (len(self.active) >= self.max_connections or
+                self.per_host.get(request.host, 0) >= self.max_per_host):
+                waiting.append(request)
+                continue
+            self._start(request)
+        self.queue = waiting
+
+    def _start(self, request):
+        pycurl = self.pycurl
+        if self.idle:
+            curl = self.idle.pop()
+            curl.reset()
+        else:
+            curl = pycurl.Curl()
+        curl.setopt(pycurl.NOSIGNAL, 1)
+        curl.setopt(pycurl.URL, 'http://%s/%s' % (request.host, request.url))
+        pwrlib.set_timeouts(curl, *request.timeouts)
+        if request.connect_only:
+            curl.setopt(pycurl.CONNECT_ONLY, 1)
+        curl.setopt(pycurl.HTTPHEADER, request.headers)
+        curl.setopt(pycurl.WRITEFUNCTION, request.chunks.append)
+        curl.setopt(pycurl.HEADERFUNCTION, request.response_headers.append)
+        if request.post_fields is not None:
+            curl.setopt(pycurl.POSTFIELDS, request.post_fields)
+        self.active[curl] = request
+        self.per_host[request.host] = self.per_host.get(request.host, 0) + 1
+        self.multi.add_handle(curl)
+
+    def _collect(self):
+        while True:
+            num_queued, succeeded, failed = self.multi.info_read()
+            for curl in succeeded:
+                request = self._finish(curl)
+                if request.connect_only:
+                    curl.close()
+                    request.future.set_result(None)
+                    continue
+                self.stats.record_transfer(request.host, curl)
+                response = Response(curl.getinfo(self.pycurl.RESPONSE_CODE), ''.join(request.chunks),
+                                    request.response_headers, curl.getinfo(self.pycurl.REDIRECT_URL))
+                self.idle.append(curl)
+                request.future.set_result(response)
+            for curl, errno, message in failed:
+                request = self._finish(curl)
+                if not request.connect_only:
+                    self.stats.record_transfer(request.host, curl, error=True)
+                curl.close()
+                try:
+                    raise Exception("Request to %s failed: %s" % (request.host, message))
+                except Exception:
+                    request.future.set_exception(sys.exc_info())
+            if not num_queued:
+                break
+
+    def _finish(self, curl):
+        self.multi.remove_handle(curl)
+        request = self.active.pop(curl)
+        self.per_host[request.host] -= 1
+        return request
+
+
+
+def _auth_header(userid, password):
+    return 'Authorization: Basic %s' % base64.b64encode('%s:%s' % (userid, password))
+
+
+def _unknown_ports(dev):
+    names = dev.status_cache.names()
+    return [[port, names.get(port, ''), 'Unknown'] for port in range(1, dev.get_num_ports() + 1)]
+
+
+def _find_status(outlets, outlet):
+    for plug in outlets or []:
+        if plug[0] == outlet:
+            return plug[2]
+    return 'Unknown'
+
+
+
+class AsyncDliSwitch:
+    """ Non-blocking counterpart of dli.DliPowerSwitch """
+    supports_cycle = True
+
+    def __init__(self, loop, userid='admin', password='4321', hostname='192.168.0.100', num_ports=8,
+                 status_ttl=pwrlib.STATUS_TTL, connect_timeout=dli.CONNECT_TIMEOUT, read_timeout=dli.READ_TIMEOUT):
+        self.loop = loop
+        self.userid = userid
+        self.password = password
+        self.hostname = hostname
+        self.num_ports = num_ports
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.status_cache = pwrlib.StatusCache(status_ttl)
+        self.health = pwrlib.Health(hostname)
+        self.headers = [ _auth_header(userid, password) ]
+
+    def get_num_ports(self):
+        return self.num_ports
+
+    def geturl(self, url='index.htm', post_fields=None):
+        """ Future for the Response to url """
+        return self.loop.fetch(self.hostname, url, self.headers, post_fields, dli.TIMEOUT,
+                               self.connect_timeout, self.read_timeout)
+
+    def _fetch(self, url, post_fields=None, check_health=True):
+        """
+        geturl() that tracks the switch's health.  Reads fail at once while the
+        switch is down; outlet control passes check_health=False and is tried
+        anyway.
+        """
+        if check_health:
+            self.health.check()
+        try:
+            response = yield self.geturl(url, post_fields)
+        except Exception as e:
+            self.health.failed(str(e))
+            raise
+        self.health.succeeded()
+        raise Return(response)
+
+    def _get_page(self, url, check_health=True):
+        response = yield self.loop.spawn(self._fetch(url, check_health=check_health))
+        if response.code != 200:
+            raise Exception("DLI Powerstrip %s@%s answered %d" % (self.userid, self.hostname, response.code))
+        raise Return(response.body)
+
+    def verify(self):
+        """ Future that is true if the switch accepts a connection """
+        return self.loop.spawn(self._verify())
+
+    def _verify(self):
+        reachable = yield self.loop.probe(self.hostname, self.connect_timeout)
+        if reachable:
+            self.health.succeeded()
+        else:
+            self.health.failed('no connection')
+        raise Return(reachable)
+
+    def on(self, outlet=0):
+        return self.set_outlets({ outlet : 'ON' })
+
+    def off(self, outlet=0):
+        return self.set_outlets({ outlet : 'OFF' })
+
+    def set_outlets(self, outlet_actions):
+        """ Future for applying a {outlet: 'ON'|'OFF'|'CCL'} map """
+        return self.loop.spawn(self._set_outlets(outlet_actions))
+
+    def _set_outlets(self, outlet_actions):
+        actions = set([action.upper() for action in outlet_actions.values()])
+        if len(actions) == 1 and sorted(outlet_actions.keys()) == range(1, self.num_ports + 1):
+            yield self.loop.spawn(self._get_page('outlet?a=%s' % actions.pop(), False))
+        else:
+            for outlet in sorted(outlet_actions.keys()):
+                yield self.loop.spawn(self._get_page('outlet?%d=%s' % (outlet, outlet_actions[outlet].upper()), False))
+        self.status_cache.update(outlet_actions)
+
+    def status_list(self):
+        """ Future for the [plugnumber, hostname, state] rows """
+        return self.loop.spawn(self._status_list())
+
+    def _status_list(self):
+        outlets = self.status_cache.get()
+        if outlets:
+            raise Return(outlets)
+        page = yield self.loop.spawn(self._get_page('index.htm'))
+        table = dli.find_outlet_table(page)
+        digest = hashlib.md5(table or page).digest()
+        outlets = self.status_cache.match(digest)
+        if not outlets:
+            with self.loop.stats.timer(self.hostname, 'parse'):
+                if dli.FAST_PARSER and table is not None:
+                    outlets = dli.parse_outlet_table(page, table)
+                if outlets is None:
+                    outlets = dli.parse_outlet_table_soup(page)
+            if outlets is None:
+                raise Return(None)
+            self.status_cache.put(outlets, digest)
+        raise Return(outlets)
+
+    def status(self, outlet=1):
+        """ Future for the state of one outlet: ON, OFF or Unknown """
+        return self.loop.spawn(self._status(outlet))
+
+    def _status(self, outlet):
+        outlets = yield self.status_list()
+        raise Return(_find_status(outlets, outlet))
+
+
+
+class AsyncStechSwitch(AsyncDliSwitch):
+    """
+    Non-blocking counterpart of stech.StechPowerSwitch.  Logs in when there is
+    no live session in sessions and once more if the switch turns the session
+    down.
+    """
+    def __init__(self, loop, userid='admin', password='4321', hostname='192.168.0.100', num_ports=8,
+                 status_ttl=pwrlib.STATUS_TTL, sessions=None, connect_timeout=stech.CONNECT_TIMEOUT,
+                 read_timeout=stech.READ_TIMEOUT):
+        AsyncDliSwitch.__init__(self, loop, userid, password, hostname, num_ports, status_ttl, connect_timeout,
+                                read_timeout)
+        self.sessions = sessions or pwrlib.DEFAULT_SESSIONS
+        self.session_key = '%s@%s' % (userid, hostname)
+
+    def _headers(self):
+        cookie = self.sessions.get(self.session_key)
+        if cookie:
+            return self.headers + [ 'Cookie: %s' % cookie ]
+        return self.headers
+
+    def geturl(self, url='outctrl.html', post_fields=None):
+        return self.loop.fetch(self.hostname, url, self._headers(), post_fields, stech.TIMEOUT,
+                               self.connect_timeout, self.read_timeout)
+
+    def _get_page(self, url, check_health=True):
+        response = yield self.loop.spawn(self._fetch(url, check_health=check_health))
+        if response.code != 200:
+            raise Exception("Stech Powerstrip %s@%s answered %d" % (self.userid, self.hostname, response.code))
+        if response.cookies():
+            self.sessions.put(self.session_key, '; '.join(response.cookies()))
+        raise Return(response.body)
+
+    def _set_outlets(self, outlet_actions):
+        actions = [ stech.ACTION_NONE ] * self.num_ports
+        for outlet, action in outlet_actions.items():
+            if outlet < 1 or outlet > self.num_ports:
+                raise Return(-1)
+            actions[outlet - 1] = stech.ACTION_CODES[action.upper()]
+        post_fields = stech._get_control_list(actions, self.num_ports)
+        for attempt in range(2):
+            if not self.sessions.get(self.session_key):
+                yield self.loop.spawn(self._get_page('outctrl.html', False)) # Login and setup cookie
+            response = yield self.loop.spawn(self._fetch('Forms/outctrl_1', post_fields, False))
+            if not (response.code in (401, 403) or response.redirect_url.lower().find('login') >= 0):
+                if response.cookies():
+                    self.sessions.put(self.session_key, '; '.join(response.cookies()))
+                self.status_cache.update(outlet_actions)
+                raise Return(None)
+            # The switch dropped our session; log in again and retry once
+            self.sessions.drop(self.session_key)
+        raise Exception("Stech Powerstrip %s@%s rejected outlet control" % (self.userid, self.hostname))
+
+    def _status_list(self):
+        outlets = self.status_cache.get()
+        if outlets:
+            raise Return(outlets)
+        page = yield self.loop.spawn(self._get_page('outctrl.html'))
+        table = stech.OUTLET_TABLE.search(page)
+        digest = hashlib.md5(table and table.group(0) or page).digest()
+        outlets = self.status_cache.match(digest)
+        if not outlets:
+            with self.loop.stats.timer(self.hostname, 'parse'):
+                outlets = stech.parse_outlet_table(page)
+            if outlets is None:
+                raise Return(None)
+            self.status_cache.put(outlets, digest)
+        raise Return(outlets)
+
+
+
+class AsyncVirtualSwitch:
+    """ Non-blocking counterpart of vswitch.VirtualPowerSwitch """
+    def __init__(self, loop, name='', switches=None):
+        self.loop = loop
+        self.name = name
+        self.switches = switches or []
+
+    def get_num_ports(self):
+        return sum([dev.get_num_ports() for dev in self.switches])
+
+    def _find_switch(self, outlet):
+        """ Map a virtual outlet to (switch, outlet on that switch) """
+        if outlet < 1:
+            return None, None
+        for dev in self.switches:
+            if outlet <= dev.get_num_ports():
+                return dev, outlet
+            outlet = outlet - dev.get_num_ports()
+        return None, None
+
+    def verify(self):
+        """ Future that is true if every switch answers """
+        return self.loop.spawn(self._verify())
+
+    def _verify(self):
+        results = yield [dev.verify() for dev in self.switches]
+        for status in results:
+            if not status:
+                raise Return(False)
+        raise Return(True)
+
+    def on(self, outlet=0):
+        return self.set_outlets({ outlet : 'ON' })
+
+    def off(self, outlet=0):
+        return self.set_outlets({ outlet : 'OFF' })
+
+    def set_outlets(self, outlet_actions):
+        """
+        Future for applying a {outlet: action} map.  Each switch gets its share
+        in one batch and all switches are driven at once.  The result is -1 if
+        any outlet is out of range.
+        """
+        return self.loop.spawn(self._set_outlets(outlet_actions))
+
+    def _set_outlets(self, outlet_actions):
+        batches = {}
+        for outlet, action in outlet_actions.items():
+            dev, dev_outlet = self._find_switch(outlet)
+            if dev is None:
+                raise Return(-1)
+            batches.setdefault(dev, {})[dev_outlet] = action
+        yield [dev.set_outlets(batches[dev]) for dev in self.switches if dev in batches]
+        raise Return(0)
+
+    def status_list(self):
+        """ Future for the [plugnumber, hostname, state] rows of every switch """
+        return self.loop.spawn(self._status_list())
+
+    def _read_status(self, dev):
+        """ A switch's rows, or Unknown rows and the error if it can't be read """
+        try:
+            ports = yield dev.status_list()
+        except Exception as e:
+            raise Return((_unknown_ports(dev), e))
+        raise Return((ports or _unknown_ports(dev), None))
+
+    def _status_list(self):
+        results = yield [self._read_status(dev) for dev in self.switches]
+        errors = [error for ports, error in results if error]
+        if errors and len(errors) == len(self.switches):
+            raise errors[0]
+        results = [ports for ports, error in results]
+        outlets = []
+        port_offset = 0
+        for dev, ports in zip(self.switches, results):
+            for port in ports or []:
+                outlets.append([port[0] + port_offset] + port[1:])
+            port_offset = port_offset + dev.get_num_ports()
+        raise Return(outlets)
+
+    def status(self, outlet=1):
+        """ Future for the state of one outlet; only its own switch is asked """
+        return self.loop.spawn(self._status(outlet))
+
+    def _status(self, outlet):
+        dev, dev_outlet = self._find_switch(outlet)
+        if dev is None or not dev.health.available():
+            raise Return('Unknown')
+        try:
+            state = yield dev.status(dev_outlet)
+        except Exception:
+            state = 'Unknown'
+        raise Return(state)
+
+
+
+def build_switch(loop, options, specs):
+    """ Create an AsyncVirtualSwitch from the output of vswitch.read_config() """
+    session_dir = options.get('sessions', stech.SESSION_DIR)
+    sessions = pwrlib.SessionCache(directory=session_dir and os.path.expanduser(session_dir) or None)
+    switches = []
+    for spec in specs:
+        kwargs = { 'userid'     : spec.get('user', 'admin'),
+                   'password'   : spec.get('password', '4321'),
+                   'hostname'   : spec['hostname'],
+                   'num_ports'  : spec['ports'] }
+        for key in ('status_ttl', 'connect_timeout', 'read_timeout'):
+            if spec.has_key(key):
+                kwargs[key] = float(spec[key])
+        if spec['type'] == 'stech':
+            switches.append(AsyncStechSwitch(loop, sessions=sessions, **kwargs))
+        else:
+            switches.append(AsyncDliSwitch(loop, **kwargs))
+    return AsyncVirtualSwitch(loop, name=options.get('name', 'lpower'), switches=switches)
@@ -0,0 +1,570 @@
+"""
+Description: Shared plumbing for the power switch drivers
+
+The dli and stech modules both talk HTTP to small embedded web servers.  This
+module holds the pieces they have in common so every switch in a
+VirtualPowerSwitch can share them.
+
+CurlPool keeps finished pycurl handles alive per host.  libcurl keeps the TCP
+connection open inside the handle, so reusing a handle for the same strip skips
+the connect (and for some strips the login) on the next request.
+
+StatusCache remembers the last outlet list read from one switch for a short
+time so several status checks in one operation cost a single page fetch.  It
+also remembers a digest of the outlet table it was parsed from, so a page that
+hasn't changed is not parsed again.
+
+SessionCache holds login cookies per host so a driver only logs in again when
+its session has expired or the device turns the cookie down.
+
+TableScanner parses a page as it streams in and hands back the outlet table as
+soon as it has been closed, so a driver can stop the transfer there.
+
+Health tracks whether a switch is answering.  After a failed request the
+switch is treated as down for a cool-down window: requests to it fail at once
+instead of waiting out a timeout, and callers report its ports as Unknown.
+probe() checks that a switch accepts connections without fetching a page.
+
+Stats counts requests and keeps a latency histogram per switch and stage (DNS,
+connect, transfer, parse, reset wait) so slow strips show up.  STATS collects
+everything this process does; a command can subscribe its own Stats to see
+just its share.  Snapshots dump as a table, JSON or Prometheus text.
+"""
+
+import os
+import re
+import json
+import socket
+import threading
+import time
+
+
+
+# Global settings
+# Idle handles kept per host
+POOL_SIZE = 4
+# Seconds an idle handle may sit in the pool before it is closed
+POOL_IDLE_TIMEOUT = 60
+# Seconds a switch's outlet list is reused before the page is fetched again
+STATUS_TTL = 2
+# Seconds a login cookie is trusted before the driver logs in again
+SESSION_LIFETIME = 300
+# Seconds a switch that failed a request is skipped before it is tried again
+HEALTH_COOLDOWN = 30
+# Seconds the reachability probe waits for a connection
+PROBE_TIMEOUT = 1
+# Upper bounds, in seconds, of the latency histogram buckets
+STATS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+
+class CurlPool:
+    """
+    Per-host pool of pycurl handles.  Acquire a handle before a request and
+    release it when the transfer is done.  Handles that failed should be
+    discarded instead so a broken connection is never reused.
+    """
+    def __init__(self, pool_size=POOL_SIZE, idle_timeout=POOL_IDLE_TIMEOUT):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, host):
+        """ Return a handle for host, reusing an idle one when possible """
+        import pycurl
+        with self.lock:
+            self._evict(time.time())
+            handles = self.idle.get(host)
+            if handles:
+                curl = handles.pop()[0]
+                curl.reset()
+            else:
+                curl = None
+        if curl is None:
+            curl = pycurl.Curl()
+        # Switches are queried from worker threads; keep libcurl off signals
+        curl.setopt(pycurl.NOSIGNAL, 1)
+        return curl
+
+    def release(self, host, curl):
+        """ Put a handle back in the pool after a successful transfer """
+        with self.lock:
+            handles = self.idle.setdefault(host, [])
+            if len(handles) < self.pool_size:
+                handles.append((curl, time.time()))
+                return
+        curl.close()
+
+    def discard(self, curl):
+        """ Drop a handle that should not be reused """
+        curl.close()
+
+    def close(self):
+        """ Close every idle handle """
+        with self.lock:
+            for handles in self.idle.values():
+                for curl, last_used in handles:
+                    curl.close()
+            self.idle = {}
+
+    def num_idle(self, host=None):
+        """ Number of idle handles for host, or for all hosts """
+        with self.lock:
+            if host is not None:
+                return len(self.idle.get(host, []))
+            return sum([len(handles) for handles in self.idle.values()])
+
+    def _evict(self, now):
+        """ Close handles that have been idle too long.  Caller holds lock. """
+        for host in self.idle.keys():
+            keep = []
+            for curl, last_used in self.idle[host]:
+                if now - last_used > self.idle_timeout:
+                    curl.close()
+                else:
+                    keep.append((curl, last_used))
+            if keep:
+                self.idle[host] = keep
+            else:
+                del(self.idle[host])
+
+
+
+class StatusCache:
+    """
+    Outlet list for one switch, valid for ttl seconds.  Rows are copied in and
+    out because callers renumber them in place.  Drivers update the cached
+    state when they switch an outlet so the cache never reports a stale state
+    for a change this process made.
+    """
+    def __init__(self, ttl=STATUS_TTL):
+        self.ttl = ttl
+        self.outlets = None
+        self.digest = None
+        self.timestamp = 0
+        self.lock = threading.Lock()
+
+    def get(self):
+        """ Return a copy of the cached outlet list, or None if it expired """
+        with self.lock:
+            if self.outlets is None or time.time() - self.timestamp > self.ttl:
+                return None
+            return [list(row) for row in self.outlets]
+
+    def match(self, digest):
+        """
+        Return a copy of the cached outlet list if it was parsed from a table
+        with this digest, whatever its age, else None.  A match counts as a
+        fresh read.
+        """
+        with self.lock:
+            if self.outlets is None or digest is None or digest != self.digest:
+                return None
+            self.timestamp = time.time()
+            return [list(row) for row in self.outlets]
+
+    def put(self, outlets, digest=None):
+        """ Remember a freshly parsed outlet list and the digest of its table """
+        with self.lock:
+            if outlets:
+                self.outlets = [list(row) for row in outlets]
+                self.digest = digest
+                self.timestamp = time.time()
+            else:
+                self.outlets = None
+
+    def update(self, outlet_actions):
+        """
+        Record the new state of switched outlets from a {outlet: action} map.
+        Anything other than a plain ON/OFF drops the whole entry.
+        """
+        with self.lock:
+            if self.outlets is None:
+                return
+            # The rows no longer match the page they were parsed from
+            self.digest = None
+            for outlet, action in outlet_actions.items():
+                state = action.upper()
+                if not state in ('ON', 'OFF'):
+                    self.outlets = None
+                    return
+                for row in self.outlets:
+                    if row[0] == outlet:
+                        row[2] = state
+
+    def names(self):
+        """ {outlet: hostname} from the last list read, however old """
+        with self.lock:
+            return dict([(row[0], row[1]) for row in self.outlets or []])
+
+    def invalidate(self):
+        """ Forget the cached outlet list """
+        with self.lock:
+            self.outlets = None
+
+
+
+class SessionCache:
+    """
+    Login cookies keyed by 'user@host'.  Entries live in memory and, when a
+    directory is given, in one small file per key so separate processes can
+    share a session without clobbering each other.
+    """
+    def __init__(self, lifetime=SESSION_LIFETIME, directory=None):
+        self.lifetime = lifetime
+        self.directory = directory
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """ Return the cookie for key, or None if there isn't a live one """
+        with self.lock:
+            entry = self.sessions.get(key)
+            if entry is None and self.directory:
+                entry = self._load(key)
+            if entry is None or entry[1] < time.time():
+                self.sessions.pop(key, None)
+                return None
+            self.sessions[key] = entry
+            return entry[0]
+
+    def put(self, key, cookie):
+        """ Remember a new login cookie for key """
+        entry = (cookie, time.time() + self.lifetime)
+        with self.lock:
+            self.sessions[key] = entry
+            if self.directory:
+                self._save(key, entry)
+
+    def drop(self, key):
+        """ Forget the session for key, e.g. after the device rejected it """
+        with self.lock:
+            self.sessions.pop(key, None)
+            if self.directory:
+                try:
+                    os.remove(self._path(key))
+                except OSError:
+                    pass
+
+    def _path(self, key):
+        return os.path.join(self.directory, re.sub(r'[^\w.@-]', '_', key))
+
+    def _load(self, key):
+        """ Read one entry from disk.  Caller holds lock. """
+        try:
+            session_file = open(self._path(key), "r")
+            expires, cookie = session_file.read().split('\t', 1)
+            session_file.close()
+            return (cookie, float(expires))
+        except (IOError, ValueError):
+            return None
+
+    def _save(self, key, entry):
+        """ Write one entry to disk atomically.  Caller holds lock. """
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory, 0700)
+            path = self._path(key)
+            temp_path = "%s.%d" % (path, os.getpid())
+            session_file = os.fdopen(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), "w")
+            session_file.write("%f\t%s" % (entry[1], entry[0]))
+            session_file.close()
+            os.rename(temp_path, path)
+        except (IOError, OSError):
+            pass
+
+
+
+class TableScanner:
+    """
+    Incremental parser for one HTML table as its page streams in.  The table
+    is the one where start_pattern matches for the (index + 1)th time.  Feed
+    it body chunks as they arrive; feed() returns True once the table's
+    closing tag has been seen, and then table holds the table's text from its
+    opening tag through its closing tag and inner holds just what's between
+    them, so the caller doesn't have to search the page again.
+
+    Patterns are expected to match within one tag.  Each chunk is searched
+    with only the unclosed tag left at the end of the last one carried over,
+    so a pattern split across chunks is still found.  A match that runs to the
+    end of the text received so far isn't accepted yet: the next chunk could
+    extend it or turn a \b into a non-boundary.  Text inside the table is
+    collected as a list of pieces and joined once when the table closes.
+    """
+    TABLE_END = re.compile(r'</table\s*>', re.I)
+
+    def __init__(self, start_pattern, index=0):
+        self.start_pattern = start_pattern
+        self.index = index
+        self.starts_seen = 0
+        self.carry = ''
+        self.parts = None
+        self.start_len = 0
+        self.table = None
+        self.inner = None
+        self.done = False
+
+    def feed(self, buf):
+        if self.done:
+            return True
+        text = self.carry + buf
+        pos = 0
+        kept = 0 # Start of the table text not yet in parts
+        while True:
+            if self.parts is None:
+                match = self.start_pattern.search(text, pos)
+            else:
+                match = self.TABLE_END.search(text, pos)
+            if not match or match.end() == len(text):
+                break
+
+            if self.parts is not None:
+                self.parts.append(text[kept:match.end()])
+                self.table = ''.join(self.parts)
+                self.inner = self.table[self.start_len:len(self.table) - len(match.group())]
+                self.parts = None
+                self.carry = ''
+                self.done = True
+                return True
+            self.starts_seen = self.starts_seen + 1
+            if self.starts_seen > self.index:
+                self.parts = []
+                self.start_len = match.end() - match.start()
+                kept = match.start()
+            pos = match.end()
+
+        # Only a match held back at the end or a tag still open can be
+        # completed by the next chunk
+        if match:
+            cut = match.start()
+        else:
+            cut = text.rfind('<', pos)
+            if cut < 0 or text.find('>', cut) >= 0:
+                cut = len(text)
+        if self.parts is not None:
+            self.parts.append(text[kept:cut])
+        self.carry = text[cut:]
+        return False
+
+
+
+class Health:
+    """
+    Up/down state of one switch.  A failure marks the switch down for
+    cooldown seconds; once that has passed the next request is let through as
+    a trial and its outcome decides the state again.
+    """
+    def __init__(self, name, cooldown=HEALTH_COOLDOWN):
+        self.name = name
+        self.cooldown = cooldown
+        self.down_until = 0
+        self.failures = 0
+        self.last_error = None
+        self.lock = threading.Lock()
+
+    def available(self):
+        """ False while the switch is in its cool-down window """
+        return time.time() >= self.down_until
+
+    def check(self):
+        """ Raise instead of letting a status read go to a switch known to be down """
+        remaining = self.down_until - time.time()
+        if remaining > 0:
+            raise Exception("%s is down (%s), retrying in %d seconds" % (self.name, self.last_error,
+                                                                         int(remaining) + 1))
+
+    def succeeded(self):
+        with self.lock:
+            self.down_until = 0
+            self.failures = 0
+            self.last_error = None
+
+    def failed(self, error=None):
+        with self.lock:
+            self.failures += 1
+            self.last_error = error
+            self.down_until = time.time() + self.cooldown
+
+    def __repr__(self):
+        if self.available():
+            return '%s: up' % self.name
+        return '%s: down for %d more seconds after %d failures (%s)' % (self.name, self.down_until - time.time(),
+                                                                       self.failures, self.last_error)
+
+
+def set_timeouts(curl, connect_timeout, read_timeout, timeout):
+    """
+    Apply separate limits to a pycurl handle: connect_timeout to open the
+    connection, read_timeout for the transfer to stall, and timeout for the
+    whole request.  A dead strip then costs connect_timeout, not timeout.
+    """
+    curl.setopt(curl.CONNECTTIMEOUT_MS, int(connect_timeout * 1000))
+    curl.setopt(curl.LOW_SPEED_LIMIT, 1)
+    curl.setopt(curl.LOW_SPEED_TIME, max(1, int(round(read_timeout))))
+    curl.setopt(curl.TIMEOUT_MS, int(timeout * 1000))
+
+
+def probe(hostname, timeout=PROBE_TIMEOUT):
+    """
+    True if hostname ('host' or 'host:port') accepts a TCP connection on its
+    web port.  Much cheaper than fetching a page and never waits longer than
+    timeout.
+    """
+    host, sep, port = hostname.rpartition(':')
+    if not sep or not port.isdigit():
+        host, port = hostname, 80
+    try:
+        socket.create_connection((host, int(port)), timeout).close()
+    except (socket.error, socket.timeout):
+        return False
+    return True
+
+
+
+class Stats:
+    """
+    Request counts, error counts, bytes and a latency histogram for each
+    (switch, stage) pair.  Other Stats objects can subscribe to receive a copy
+    of every sample recorded here while they are subscribed.
+    """
+    def __init__(self, buckets=STATS_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.entries = {}
+        self.subscribers = []
+        self.lock = threading.Lock()
+
+    def record(self, switch, stage, seconds, nbytes=0, error=False):
+        """ Add one sample """
+        with self.lock:
+            entry = self.entries.get((switch, stage))
+            if entry is None:
+                entry = { 'count' : 0, 'errors' : 0, 'seconds' : 0.0, 'max' : 0.0, 'bytes' : 0,
+                          'buckets' : [0] * (len(self.buckets) + 1) }
+                self.entries[(switch, stage)] = entry
+            entry['count'] += 1
+            entry['seconds'] += seconds
+            entry['max'] = max(entry['max'], seconds)
+            entry['bytes'] += nbytes
+            if error:
+                entry['errors'] += 1
+            index = 0
+            while index < len(self.buckets) and seconds > self.buckets[index]:
+                index += 1
+            entry['buckets'][index] += 1
+            subscribers = list(self.subscribers)
+        for stats in subscribers:
+            stats.record(switch, stage, seconds, nbytes, error)
+
+    def timer(self, switch, stage):
+        """ Context manager that records the time spent in its block """
+        return _StatsTimer(self, switch, stage)
+
+    def record_transfer(self, switch, curl, error=False):
+        """
+        Record the DNS, connect and transfer time of a finished pycurl request.
+        A reused connection shows up as a zero connect time.
+        """
+        lookup = curl.getinfo(curl.NAMELOOKUP_TIME)
+        connect = curl.getinfo(curl.CONNECT_TIME)
+        total = curl.getinfo(curl.TOTAL_TIME)
+        self.record(switch, 'dns', lookup)
+        self.record(switch, 'connect', max(connect - lookup, 0.0))
+        self.record(switch, 'transfer', max(total - connect, 0.0),
+                    int(curl.getinfo(curl.SIZE_DOWNLOAD) + curl.getinfo(curl.SIZE_UPLOAD)), error)
+
+    def subscribe(self, stats):
+        with self.lock:
+            self.subscribers.append(stats)
+
+    def unsubscribe(self, stats):
+        with self.lock:
+            if stats in self.subscribers:
+                self.subscribers.remove(stats)
+
+    def snapshot(self):
+        """ Return [(switch, stage, entry dict)] sorted by switch and stage """
+        with self.lock:
+            return [ (key[0], key[1], dict(entry, buckets=list(entry['buckets'])))
+                     for key, entry in sorted(self.entries.items()) ]
+
+    def format_table(self):
+        """ Human readable summary, one line per switch and stage """
+        lines = [ '%-22.22s\t%-10s\t%6s\t%6s\t%9s\t%9s\t%9s' % ('Switch', 'Stage', 'Count', 'Errors',
+                                                                   'Mean ms', 'Max ms', 'KB/s') ]
+        for switch, stage, entry in self.snapshot():
+            rate = '-'
+            if entry['bytes'] and entry['seconds'] > 0:
+                rate = '%.1f' % (entry['bytes'] / entry['seconds'] / 1024)
+            lines.append('%-22.22s\t%-10s\t%6d\t%6d\t%9.2f\t%9.2f\t%9s' % (switch, stage, entry['count'],
+                         entry['errors'], entry['seconds'] / entry['count'] * 1e3, entry['max'] * 1e3, rate))
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self):
+        """ JSON list of every switch and stage with its histogram """
+        samples = []
+        for switch, stage, entry in self.snapshot():
+            entry['switch'] = switch
+            entry['stage'] = stage
+            entry['bucket_bounds'] = list(self.buckets)
+            samples.append(entry)
+        return json.dumps(samples, indent=2, sort_keys=True) + '\n'
+
+    def to_prometheus(self):
+        """ Prometheus text exposition format """
+        lines = [ '# HELP lpower_stage_seconds Time spent per switch and stage',
+                  '# TYPE lpower_stage_seconds histogram' ]
+        snapshot = self.snapshot()
+        for switch, stage, entry in snapshot:
+            labels = 'switch="%s",stage="%s"' % (_prom_escape(switch), _prom_escape(stage))
+            cumulative = 0
+            for bound, count in zip(list(self.buckets) + ['+Inf'], entry['buckets']):
+                cumulative += count
+                lines.append('lpower_stage_seconds_bucket{%s,le="%s"} %d' % (labels, bound, cumulative))
+            lines.append('lpower_stage_seconds_sum{%s} %f' % (labels, entry['seconds']))
+            lines.append('lpower_stage_seconds_count{%s} %d' % (labels, entry['count']))
+        for name, key, help in (('lpower_stage_errors_total', 'errors', 'Failed requests per switch and stage'),
+                                ('lpower_stage_bytes_total', 'bytes', 'Bytes moved per switch and stage')):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s counter' % name)
+            for switch, stage, entry in snapshot:
+                lines.append('%s{switch="%s",stage="%s"} %d' % (name, _prom_escape(switch),
+                                                                _prom_escape(stage), entry[key]))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, format):
+        """ Snapshot as 'table', 'json' or 'prom' text """
+        if format == 'json':
+            return self.to_json()
+        if format == 'prom':
+            return self.to_prometheus()
+        if format == 'table':
+            return self.format_table()
+        raise Exception("Unknown stats format %s" % format)
+
+
+
+class _StatsTimer:
+    def __init__(self, stats, switch, stage):
+        self.stats = stats
+        self.switch = switch
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stats.record(self.switch, self.stage, time.time() - self.start, error=exc_type is not None)
+        return False
+
+
+def _prom_escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+
+# Shared by every driver that isn't handed its own
+DEFAULT_POOL = CurlPool()
+DEFAULT_SESSIONS = SessionCache()
+STATS = Stats()
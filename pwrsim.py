@@ -0,0 +1,373 @@
+#!/usr/bin/python
+"""
+Description: Simulated DLI and Stech power strips for testing without hardware
+
+Each SimulatedStrip is a small HTTP server that answers the requests the dli
+and stech drivers make:
+
+    DLI:    GET  /index.htm              outlet table
+            GET  /outlet?N=ON|OFF|CCL    switch one outlet
+            GET  /outlet?a=ON|OFF|CCL    switch every outlet
+    Stech:  GET  /outctrl.html           outlet table, hands out a session cookie
+            POST /Forms/outctrl_1        ControlAction?N=0..3 for every outlet
+
+Pages are the recorded pages in fixtures/ with the outlet rows redrawn from
+the simulated state, so the drivers parse exactly what a real strip sends.
+Basic auth is checked on every request and the Stech form bounces to the login
+page without a live session cookie.
+
+Latency and faults are configurable per strip: a fixed delay plus random
+jitter before each reply, a fraction of requests answered with 503, a
+fraction of connections dropped without a reply, and a down switch that drops
+everything.  Cycled outlets come back on after cycle_delay seconds.
+
+Run as a script to serve a farm of strips and write an lpower config file that
+points at them:
+
+    prompt% python pwrsim.py -n 10 --type mixed --latency 0.02 --config /tmp/sim.conf
+    prompt% LPOWER_CONFIG=/tmp/sim.conf ./lpower1 status
+"""
+import os
+import re
+import sys
+import time
+import random
+import base64
+import threading
+import BaseHTTPServer
+import SocketServer
+
+
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+DLI_TEMPLATE = os.path.join(FIXTURE_DIR, 'dli_index.htm')
+STECH_TEMPLATE = os.path.join(FIXTURE_DIR, 'stech_outctrl.html')
+STRIP_TYPES = [ 'dli', 'stech' ]
+# Seconds a Stech session cookie stays valid
+SESSION_LIFETIME = 300
+STECH_ACTIONS = { '1' : 'ON', '2' : 'OFF', '3' : 'CCL' }
+
+
+
+def _split_template(filename, row_pattern):
+    """
+    Split a recorded page around its outlet rows.  Returns (text before the
+    first row, text after the last row).
+    """
+    page = open(filename).read()
+    rows = list(re.finditer(row_pattern, page, re.I | re.S))
+    if not rows:
+        raise Exception("No outlet rows found in %s" % filename)
+    return page[:rows[0].start()], page[rows[-1].end():]
+
+
+def _dli_row(port, name, state):
+    if state == 'ON':
+        return ('<tr bgcolor="#F4F4F4"><td align=center>%d</td>\n<td>%s</td><td>\n'
+                '<b><font color=green>ON</font></b></td><td>\n<a href=outlet?%d=OFF>Switch OFF</a></td><td>\n'
+                '<a href=outlet?%d=CCL>Cycle</a></td></tr>\n' % (port, name, port, port))
+    return ('<tr bgcolor="#F4F4F4"><td align=center>%d</td>\n<td>%s</td><td>\n'
+            '<b><font color=red>OFF</font></b></td><td>\n<a href=outlet?%d=ON>Switch ON</a></td><td>\n'
+            '&nbsp;</td></tr>\n' % (port, name, port))
+
+
+def _stech_row(port, name, state):
+    font = '<td><font face="Arial, Helvetica" size="2">%s</font></td>\n'
+    state = state == 'ON' and 'On' or 'Off'
+    row = '<tr bgcolor="%s">\n' % (port % 2 and '#F0F0F0' or '#FFFFFF')
+    row += font % ('<input type="checkbox" name="OutletSelect?%d" value="1">' % port)
+    row = row.replace('<td>', '<td align="center">', 1)
+    row += font % ('&nbsp;AA%d&nbsp;' % port)
+    row += font % ('&nbsp;%s&nbsp;' % name)
+    row += font % ('&nbsp;%s&nbsp;' % state)
+    row += font % ('&nbsp;%s&nbsp;' % state)
+    row += font % ('<select name="ControlAction?%d">\n<option value="0" selected>None</option>\n'
+                   '<option value="1">On</option>\n<option value="2">Off</option>\n'
+                   '<option value="3">Reboot</option>\n</select>' % port)
+    return row + '</tr>'
+
+
+
+class SimulatedStrip:
+    """
+    State and behaviour of one strip.  Attributes latency, jitter,
+    failure_rate, drop_rate, down and cycle_delay can be changed while the
+    server is running.
+    """
+    def __init__(self, strip_type='dli', num_ports=8, userid='admin', password='4321', name=None,
+                 latency=0.0, jitter=0.0, failure_rate=0.0, drop_rate=0.0, cycle_delay=1.0):
+        if not strip_type in STRIP_TYPES:
+            raise Exception("Unknown strip type %s (%s)" % (strip_type, ', '.join(STRIP_TYPES)))
+        self.strip_type = strip_type
+        self.num_ports = num_ports
+        self.userid = userid
+        self.password = password
+        self.name = name or 'sim-%s' % strip_type
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.drop_rate = drop_rate
+        self.down = False
+        self.cycle_delay = cycle_delay
+        self.names = [ 'Outlet %d' % port for port in range(1, num_ports + 1) ]
+        self.states = [ 'ON' ] * num_ports
+        self.sessions = {}
+        self.requests = 0
+        self.failures = 0
+        self.lock = threading.Lock()
+        self.server = None
+        if strip_type == 'dli':
+            self.template = _split_template(DLI_TEMPLATE, r'<tr bgcolor="#F4F4F4">.*?</tr>\s*')
+        else:
+            self.template = _split_template(STECH_TEMPLATE, r'<tr bgcolor="#[0-9A-F]+">\s*<td align="center">'
+                                                            r'<font[^>]*><input type="checkbox".*?</tr>')
+
+    def start(self, address='127.0.0.1', port=0):
+        """ Serve on address:port (0 picks a free port) from a background thread """
+        self.server = _Server((address, port), _Handler)
+        self.server.strip = self
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    @property
+    def hostname(self):
+        return '%s:%d' % self.server.server_address
+
+    def config_section(self, section):
+        """ An lpower config section describing this strip """
+        return ("[%s]\ntype = %s\nhostname = %s\nuser = %s\npassword = %s\nports = %d\n" %
+                (section, self.strip_type, self.hostname, self.userid, self.password, self.num_ports))
+
+    def render(self):
+        """ The outlet page for the current state """
+        with self.lock:
+            rows = zip(range(1, self.num_ports + 1), self.names, self.states)
+        if self.strip_type == 'dli':
+            head = re.sub(r'(<font size="-1">)[^<]*(</font>)', r'\g<1>%s\g<2>' % time.strftime('%A, %B %d, %Y %H:%M:%S'),
+                          self.template[0], 1)
+            return head + ''.join([_dli_row(*row) for row in rows]) + self.template[1]
+        return self.template[0] + '\n'.join([_stech_row(*row) for row in rows]) + self.template[1]
+
+    def set_outlets(self, outlet_actions):
+        """ Apply {outlet: 'ON'|'OFF'|'CCL'}; cycled outlets come back on later """
+        cycled = []
+        with self.lock:
+            for outlet, action in outlet_actions.items():
+                if outlet < 1 or outlet > self.num_ports:
+                    continue
+                if action == 'CCL':
+                    if self.states[outlet - 1] == 'ON':
+                        self.states[outlet - 1] = 'OFF'
+                        cycled.append(outlet)
+                else:
+                    self.states[outlet - 1] = action
+        if cycled:
+            timer = threading.Timer(self.cycle_delay, self.set_outlets, [dict([(outlet, 'ON') for outlet in cycled])])
+            timer.daemon = True
+            timer.start()
+
+    def new_session(self):
+        cookie = 'C0=%08x' % random.getrandbits(32)
+        with self.lock:
+            self.sessions[cookie] = time.time() + SESSION_LIFETIME
+        return cookie
+
+    def has_session(self, cookie_header):
+        now = time.time()
+        with self.lock:
+            for cookie in (cookie_header or '').split(';'):
+                if self.sessions.get(cookie.strip(), 0) > now:
+                    return True
+        return False
+
+    def drop_sessions(self):
+        """ Forget every session, as a strip does when it reboots """
+        with self.lock:
+            self.sessions = {}
+
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send each reply in one write; header-by-header writes on a keep-alive
+    # connection stall on delayed ACKs and swamp the simulated latency
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, code, body='', headers=None):
+        self.send_response(code)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _begin(self):
+        """
+        Apply latency and fault injection.  Returns False if the request was
+        already answered (or dropped).
+        """
+        strip = self.server.strip
+        with strip.lock:
+            strip.requests += 1
+        delay = strip.latency + random.uniform(0, strip.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if strip.down or random.random() < strip.drop_rate:
+            with strip.lock:
+                strip.failures += 1
+            self.close_connection = 1
+            return False
+        if random.random() < strip.failure_rate:
+            with strip.lock:
+                strip.failures += 1
+            self._reply(503, 'Service Unavailable')
+            return False
+        expected = 'Basic ' + base64.b64encode('%s:%s' % (strip.userid, strip.password))
+        if self.headers.getheader('Authorization') != expected:
+            self._reply(401, 'Unauthorized', { 'WWW-Authenticate' : 'Basic realm="%s"' % strip.name })
+            return False
+        return True
+
+    def do_GET(self):
+        strip = self.server.strip
+        if not self._begin():
+            return
+        path, sep, query = self.path.lstrip('/').partition('?')
+        if strip.strip_type == 'dli':
+            if path in ('', 'index.htm'):
+                return self._reply(200, strip.render())
+            match = re.match(r'^(\d+|a)=(ON|OFF|CCL)$', query)
+            if path == 'outlet' and match:
+                if match.group(1) == 'a':
+                    outlets = range(1, strip.num_ports + 1)
+                else:
+                    outlets = [ int(match.group(1)) ]
+                strip.set_outlets(dict([(outlet, match.group(2)) for outlet in outlets]))
+                return self._reply(200, strip.render())
+        elif path == 'outctrl.html':
+            headers = {}
+            if not strip.has_session(self.headers.getheader('Cookie')):
+                headers['Set-Cookie'] = '%s; path=/' % strip.new_session()
+            return self._reply(200, strip.render(), headers)
+        self._reply(404, 'Not Found')
+
+    def do_POST(self):
+        strip = self.server.strip
+        length = int(self.headers.getheader('Content-Length') or 0)
+        body = self.rfile.read(length)
+        if not self._begin():
+            return
+        if strip.strip_type != 'stech' or self.path.lstrip('/') != 'Forms/outctrl_1':
+            return self._reply(404, 'Not Found')
+        if not strip.has_session(self.headers.getheader('Cookie')):
+            return self._reply(302, '', { 'Location' : '/login.html' })
+        actions = {}
+        for field in body.split('&'):
+            match = re.match(r'^ControlAction(?:%3F|\?)(\d+)=(\d)$', field)
+            if match and STECH_ACTIONS.has_key(match.group(2)):
+                actions[int(match.group(1))] = STECH_ACTIONS[match.group(2)]
+        strip.set_outlets(actions)
+        self._reply(302, '', { 'Location' : '/outctrl.html' })
+
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 64
+
+
+
+def start_farm(count, strip_type='dli', num_ports=8, **kwargs):
+    """
+    Start count strips on free local ports.  strip_type 'mixed' alternates DLI
+    and Stech strips.  Extra keyword arguments go to SimulatedStrip.
+    """
+    strips = []
+    for index in range(count):
+        kind = strip_type
+        if strip_type == 'mixed':
+            kind = STRIP_TYPES[index % len(STRIP_TYPES)]
+        strip = SimulatedStrip(kind, num_ports, name='sim%d' % (index + 1), **kwargs)
+        strips.append(strip.start())
+    return strips
+
+
+def stop_farm(strips):
+    for strip in strips:
+        strip.stop()
+
+
+def write_config(filename, strips, name='Simulated Rack', directory=None):
+    """
+    Write an lpower config file for strips.  Settings, socket and sessions go
+    in directory (default: next to the config file) so a simulated rack never
+    touches the real ones.
+    """
+    directory = directory or os.path.dirname(os.path.abspath(filename))
+    lines = [ "[lpower]\nname = %s\nsettings = %s\nsocket = %s\nsessions = %s\n" %
+              (name, os.path.join(directory, 'lpower-sim'), os.path.join(directory, 'lpower-sim.sock'),
+               os.path.join(directory, 'lpower-sim-sessions')) ]
+    for strip in strips:
+        lines.append(strip.config_section(strip.name))
+    temp_name = '%s.%d' % (filename, os.getpid())
+    config_file = open(temp_name, 'w')
+    config_file.write('\n'.join(lines))
+    config_file.close()
+    # Readers poll for the file; only show it once it is complete
+    os.rename(temp_name, filename)
+
+
+
+def main():
+    import optparse
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('-n', '--strips', type='int', default=1, help='number of strips [default 1]')
+    parser.add_option('-t', '--type', default='dli', help='dli, stech or mixed [default dli]')
+    parser.add_option('-p', '--ports', type='int', default=8, help='outlets per strip [default 8]')
+    parser.add_option('-u', '--user', default='admin', help='login user [default admin]')
+    parser.add_option('-w', '--password', default='4321', help='login password [default 4321]')
+    parser.add_option('-l', '--latency', type='float', default=0.0, help='seconds before each reply')
+    parser.add_option('-j', '--jitter', type='float', default=0.0, help='extra random seconds, up to this')
+    parser.add_option('-f', '--failure-rate', type='float', default=0.0, help='fraction of requests answered 503')
+    parser.add_option('-d', '--drop-rate', type='float', default=0.0, help='fraction of connections dropped')
+    parser.add_option('--cycle-delay', type='float', default=1.0, help='seconds a cycled outlet stays off')
+    parser.add_option('-c', '--config', help='write an lpower config file for the farm here')
+    (options, args) = parser.parse_args()
+
+    if options.type != 'mixed' and not options.type in STRIP_TYPES:
+        sys.stderr.write("Error: unknown strip type %s\n" % options.type)
+        sys.exit(-1)
+    strips = start_farm(options.strips, options.type, options.ports, userid=options.user,
+                        password=options.password, latency=options.latency, jitter=options.jitter,
+                        failure_rate=options.failure_rate, drop_rate=options.drop_rate,
+                        cycle_delay=options.cycle_delay)
+    if options.config:
+        write_config(options.config, strips)
+    for strip in strips:
+        print '%s\t%s\t%s' % (strip.name, strip.strip_type, strip.hostname)
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    stop_farm(strips)
+
+
+
+if __name__ == "__main__":
+    main()
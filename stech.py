@@ -15,23 +15,37 @@ The interface is based on a dli.py script written by Dwight Hubbard.
 """
 
 import re
-import pycurl
-import BeautifulSoup
-import optparse
 import base64
+import hashlib
 import os
-import urllib
+import threading
+import pwrlib
 
 
 
+# pycurl and BeautifulSoup are imported where they are used so that importing
+# this module (e.g. for a CLI command that never touches the network) is cheap
+
 # Global settings
-# Timeout in seconds
+# Timeout in seconds for a whole request
 TIMEOUT = 5
-COOKIEFILE = os.path.expanduser('~/.pwr-cookies')
+# Seconds to wait for a connection, and for a stalled transfer to resume
+CONNECT_TIMEOUT = 2
+READ_TIMEOUT = 3
+# Per-host session store used when run as a script
+SESSION_DIR = os.path.expanduser('~/.pwr-sessions')
 ACTION_NONE  = 0
 ACTION_ON    = 1
 ACTION_OFF   = 2
 ACTION_RESET = 3
+ACTION_CODES = { 'ON'  : ACTION_ON,
+                 'OFF' : ACTION_OFF,
+                 'CCL' : ACTION_RESET }
+# Stop downloading outctrl.html once the outlet table is complete.  Aborting a
+# transfer closes the connection, so this only pays off on slow switches
+STREAMING = False
+OUTLET_TABLE_START = re.compile(r'<table\b[^>]*cellpadding\s*=\s*["\']?1\b', re.I)
+OUTLET_TABLE = re.compile(OUTLET_TABLE_START.pattern + r'.*?</table\s*>', re.I | re.S)
 
 
 
@@ -52,6 +66,28 @@ def _get_control_list(actions, num_ports):
         post_fields = post_fields + control
     return post_fields
 
+def parse_outlet_table(outlet_control_page):
+    """ Pull [plugnumber, hostname, state] rows out of outctrl.html """
+    outlets = []
+    import BeautifulSoup
+    soup = BeautifulSoup.BeautifulSoup(outlet_control_page)
+    try:
+        outlet_table = soup.find('table', cellpadding='1')
+        rows = outlet_table.findAll('tr')[4:]
+        for row in rows:
+            columns = row.findAll('td', colspan=None)
+            if len(columns) < 6:
+                break
+            port_id = re.sub('&nbsp;', '', columns[1].font.string)
+            hostname = re.sub('&nbsp;', '', columns[2].font.string)
+            num = int(re.sub(r'A', r'', port_id))
+            state = re.sub('&nbsp;', '', columns[3].font.string)
+            state = _format_state(state)
+            outlets.append([ num, hostname, state ])
+    except IndexError:
+        return None
+    return outlets
+
 
 
 class StechPowerSwitch:
@@ -59,104 +95,201 @@ class StechPowerSwitch:
     Sentry Switched CDU control class.  Based on the interface for the DLI power
     strip.
     """
-    def __init__(self, userid='admin', password='4321', hostname='192.168.0.100', num_ports=8):
+    # The outlet control form has a Reboot action, sent as 'CCL'
+    supports_cycle = True
+
+    def __init__(self, userid='admin', password='4321', hostname='192.168.0.100', num_ports=8, pool=None,
+                 status_ttl=pwrlib.STATUS_TTL, sessions=None, streaming=STREAMING, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT):
         self.userid = userid
         self.password = password
         self.hostname = hostname
         self.contents = ''
+        self.chunks = []
+        self.scanner = None
+        self.streaming = streaming
         self.num_ports = num_ports
-        try:
-            os.remove(COOKIEFILE)
-        except OSError:
-            pass
+        self.pool = pool or pwrlib.DEFAULT_POOL
+        self.status_cache = pwrlib.StatusCache(status_ttl)
+        self.sessions = sessions or pwrlib.DEFAULT_SESSIONS
+        self.stats = pwrlib.STATS
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.health = pwrlib.Health(hostname)
+        # Requests share the chunk buffer and cookie list, one at a time
+        self.lock = threading.RLock()
+        self.session_key = '%s@%s' % (userid, hostname)
+        self.new_cookies = []
 
     def verify(self):
-        """ Verify we can reach the switch, returns true if ok """
-        return self.geturl()
+        """
+        Verify we can reach the switch, returns true if ok.  Only opens a
+        connection, no page is fetched.
+        """
+        if pwrlib.probe(self.hostname, self.connect_timeout):
+            self.health.succeeded()
+            return True
+        self.health.failed('no connection')
+        return False
 
     def body_callback(self, buf):
         """ Called by pycurl as it's reading data from the server """
-        self.contents = self.contents + buf
+        self.chunks.append(buf)
+        if self.scanner and self.scanner.feed(buf):
+            return 0 # Outlet table is complete, abort the rest of the page
 
-    def geturl(self, url='outctrl.html'):
-        """
-        Get the HTML located at URL for the power switch.
-        """
+    def header_callback(self, line):
+        """ Called by pycurl for each response header, collects the session cookie """
+        if line.lower().startswith('set-cookie:'):
+            self.new_cookies.append(line.split(':', 1)[1].split(';', 1)[0].strip())
+
+    def _setup_curl(self, url):
+        """ Get a pooled handle set up for url with auth and the current session """
         self.contents = ''
+        self.chunks = []
+        self.new_cookies = []
         headers = { 'Authorization'   : 'Basic %s' % base64.b64encode("%s:%s" % (self.userid, self.password)) }
 
-        curl = pycurl.Curl()
-        curl.setopt(curl.TIMEOUT, TIMEOUT)
+        curl = self.pool.acquire(self.hostname)
+        pwrlib.set_timeouts(curl, self.connect_timeout, self.read_timeout, TIMEOUT)
         curl.setopt(curl.URL, "http://%s/%s" % (self.hostname, url))
         curl.setopt(curl.HTTPHEADER, ["%s: %s" % t for t in headers.items()])
         curl.setopt(curl.WRITEFUNCTION, self.body_callback)
-        curl.setopt(curl.COOKIEJAR, COOKIEFILE)
-        curl.setopt(curl.COOKIEFILE, COOKIEFILE)
-        try:
-            curl.perform()
-            curl.close()
-        except pycurl.error:
-            raise Exception("Could not login to Stech Powerstrip %s@%s" % (self.userid, self.hostname))
-            return None
-        return self.contents
+        curl.setopt(curl.HEADERFUNCTION, self.header_callback)
+        cookie = self.sessions.get(self.session_key)
+        if cookie:
+            curl.setopt(curl.COOKIE, cookie)
+        return curl
+
+    def _save_session(self):
+        """ Keep any cookie the switch handed out with the last response """
+        if self.new_cookies:
+            self.sessions.put(self.session_key, '; '.join(self.new_cookies))
+
+    def geturl(self, url='outctrl.html', scanner=None, check_health=True):
+        """
+        Get the HTML located at URL for the power switch.  This also logs in and
+        picks up a session cookie.  With a scanner the transfer stops as soon as
+        the scanner has seen what it is looking for.  The login for outlet
+        control passes check_health=False so it is tried even while the switch
+        is in its cool-down.
+        """
+        import pycurl
+        with self.lock:
+            if check_health:
+                self.health.check()
+            curl = self._setup_curl(url)
+            self.scanner = scanner
+            try:
+                curl.perform()
+            except pycurl.error as e:
+                if not (scanner and scanner.done and e.args[0] == pycurl.E_WRITE_ERROR):
+                    self.stats.record_transfer(self.hostname, curl, error=True)
+                    self.pool.discard(curl)
+                    self.health.failed(e.args[-1])
+                    raise Exception("Could not login to Stech Powerstrip %s@%s" % (self.userid, self.hostname))
+                    return None
+            self.stats.record_transfer(self.hostname, curl)
+            self.health.succeeded()
+            self.pool.release(self.hostname, curl)
+            self.scanner = None
+            self._save_session()
+            self.contents = ''.join(self.chunks)
+            self.chunks = []
+            return self.contents
 
     def off(self, outlet=0):
         """ Turn off a power to an outlet """
         if outlet < 1:
             return -1
-        self.geturl() # Login and setup cookie
-        actions = [ ACTION_NONE ] * self.num_ports
-        actions[outlet - 1] = ACTION_OFF
-        self._post_outlet_control(actions)
+        return self.set_outlets({ outlet : 'OFF' })
 
     def on(self, outlet=0):
         """ Turn on power to an outlet """
         if outlet < 1:
             return -1
-        self.geturl() # Login and setup cookie
+        return self.set_outlets({ outlet : 'ON' })
+
+    def set_outlets(self, outlet_actions):
+        """
+        Apply a {outlet: action} map, where action is 'ON', 'OFF' or 'CCL'
+        (reboot, using the delay configured on the strip).  The
+        control form carries an action for every port, so any number of outlets
+        costs one POST, plus a login when there is no live session.
+        """
         actions = [ ACTION_NONE ] * self.num_ports
-        actions[outlet - 1] = ACTION_ON
-        self._post_outlet_control(actions)
+        for outlet, action in outlet_actions.items():
+            if outlet < 1 or outlet > self.num_ports:
+                return -1
+            actions[outlet - 1] = ACTION_CODES[action.upper()]
+        if not self.sessions.get(self.session_key):
+            self.geturl(check_health=False) # Login and setup cookie
+        if not self._post_outlet_control(actions):
+            # The switch dropped our session; log in again and retry once
+            self.sessions.drop(self.session_key)
+            self.geturl(check_health=False)
+            if not self._post_outlet_control(actions):
+                raise Exception("Stech Powerstrip %s@%s rejected outlet control" % (self.userid, self.hostname))
+        self.status_cache.update(outlet_actions)
 
     def _post_outlet_control(self, actions):
-        """ Post a set of actions to the outlet control form """
-        self.contents = ''
-        post_fields = _get_control_list(actions, self.num_ports)
-        curl = pycurl.Curl()
-        headers = { 'Authorization'   : 'Basic %s' % base64.b64encode("%s:%s" % (self.userid, self.password)) }
-        curl.setopt(curl.HTTPHEADER, ["%s: %s" % t for t in headers.items()])
-        curl.setopt(curl.URL, 'http://%s/Forms/outctrl_1' % self.hostname)
-        curl.setopt(curl.POSTFIELDS, post_fields)
-        curl.setopt(curl.WRITEFUNCTION, self.body_callback)
-        curl.setopt(curl.COOKIEJAR, COOKIEFILE)
-        curl.setopt(curl.COOKIEFILE, COOKIEFILE)
-        curl.perform()
+        """
+        Post a set of actions to the outlet control form.  Returns False if the
+        switch turned the session down (auth error or a bounce to the login
+        page) so the caller can log in again.
+        """
+        import pycurl
+        with self.lock:
+            post_fields = _get_control_list(actions, self.num_ports)
+            curl = self._setup_curl('Forms/outctrl_1')
+            curl.setopt(curl.POSTFIELDS, post_fields)
+            try:
+                curl.perform()
+            except pycurl.error as e:
+                self.stats.record_transfer(self.hostname, curl, error=True)
+                self.pool.discard(curl)
+                self.health.failed(e.args[-1])
+                raise Exception("Could not login to Stech Powerstrip %s@%s" % (self.userid, self.hostname))
+            self.stats.record_transfer(self.hostname, curl)
+            self.health.succeeded()
+            response_code = curl.getinfo(curl.RESPONSE_CODE)
+            location = curl.getinfo(curl.REDIRECT_URL) or ''
+            self.pool.release(self.hostname, curl)
+            if response_code in (401, 403) or location.lower().find('login') >= 0:
+                return False
+            self._save_session()
+            return True
 
     def status_list(self):
         """
         RETURN the status of all outlets in a list, each item will contain 3
-        itmes plugnumber, hostname and state
+        itmes plugnumber, hostname and state.  The list is reused for
+        status_cache.ttl seconds after a fetch, and the page isn't parsed again
+        if its outlet table hasn't changed.
         """
-        outlets = []
-        outlet_control_page = self.geturl('outctrl.html')
+        outlets = self.status_cache.get()
+        if outlets:
+            return outlets
+        scanner = None
+        if self.streaming:
+            scanner = pwrlib.TableScanner(OUTLET_TABLE_START)
+        outlet_control_page = self.geturl('outctrl.html', scanner)
         if not outlet_control_page:
             return None
-        soup = BeautifulSoup.BeautifulSoup(outlet_control_page)
-        try:
-            outlet_table = soup.find('table', cellpadding='1')
-            rows = outlet_table.findAll('tr')[4:]
-            for row in rows:
-                columns = row.findAll('td', colspan=None)
-                if len(columns) < 6:
-                    break
-                port_id = re.sub('&nbsp;', '', columns[1].font.string)
-                hostname = re.sub('&nbsp;', '', columns[2].font.string)
-                num = int(re.sub(r'A', r'', port_id))
-                state = re.sub('&nbsp;', '', columns[3].font.string)
-                state = _format_state(state)
-                outlets.append([ num, hostname, state ])
-        except IndexError:
+        if scanner and scanner.done:
+            table = scanner.table
+        else:
+            match = OUTLET_TABLE.search(outlet_control_page)
+            table = match and match.group(0)
+        digest = hashlib.md5(table or outlet_control_page).digest()
+        cached = self.status_cache.match(digest)
+        if cached:
+            return cached
+        with self.stats.timer(self.hostname, 'parse'):
+            outlets = parse_outlet_table(table or outlet_control_page)
+        if outlets is None:
             return None
+        self.status_cache.put(outlets, digest)
         return outlets
 
     def print_status(self):
@@ -184,13 +317,16 @@ class StechPowerSwitch:
 
 
 if __name__ == "__main__":
+    import optparse
     parser = optparse.OptionParser()
     parser.add_option('--hostname', dest='hostname', default="10.0.54.123")
     parser.add_option('--user',     dest='user',     default="bsplab")
     parser.add_option('--password', dest='password', default="bsplab")
     (options, args) = parser.parse_args()
 
-    switch = StechPowerSwitch(userid=options.user, password=options.password, hostname=options.hostname)
+    sessions = pwrlib.SessionCache(directory=SESSION_DIR)
+    switch = StechPowerSwitch(userid=options.user, password=options.password, hostname=options.hostname,
+                              sessions=sessions)
     if len(args):
         if len(args) == 2:
             if args[0].lower() in ['on', 'poweron']:
@@ -0,0 +1,172 @@
+#!/usr/bin/python
+"""
+Description: Tests for burn.py's Intel HEX and S-record decoding
+
+    prompt% python -m unittest test_burn
+"""
+import os
+import sys
+import unittest
+import tempfile
+import optparse
+import burn
+
+
+
+def intel_hex_record(record_type, offset, data=''):
+    """ One Intel HEX record line with a correct checksum """
+    body = chr(len(data)) + chr(offset >> 8) + chr(offset & 0xFF) + chr(record_type) + data
+    return ':%s%02X\n' % (body.encode('hex').upper(), (-sum(bytearray(body))) & 0xFF)
+
+
+def srecord(record_type, address, data=''):
+    """ One S-record line with a correct checksum and the type's address length """
+    address_len = burn.SRECORD_ADDRESS_BYTES.get(record_type, 2)
+    address_bytes = ('%0*X' % (address_len * 2, address)).decode('hex')
+    body = chr(len(address_bytes) + len(data) + 1) + address_bytes + data
+    return 'S%s%s%02X\n' % (record_type, body.encode('hex').upper(), 0xFF - (sum(bytearray(body)) & 0xFF))
+
+
+def encode_intel_hex(address, data, record_bytes=16):
+    """ data at address as Intel HEX with extended linear address records """
+    lines = []
+    upper = None
+    for offset in range(0, len(data), record_bytes):
+        record_address = address + offset
+        if record_address >> 16 != upper:
+            upper = record_address >> 16
+            lines.append(intel_hex_record(4, 0, chr(upper >> 8) + chr(upper & 0xFF)))
+        lines.append(intel_hex_record(0, record_address & 0xFFFF, data[offset:offset + record_bytes]))
+    return ''.join(lines)
+
+
+def encode_srecord(address, data, record_bytes=16):
+    """ data at address as S3 records """
+    return ''.join([srecord('3', address + offset, data[offset:offset + record_bytes])
+                    for offset in range(0, len(data), record_bytes)])
+
+
+
+class DecodeTest(unittest.TestCase):
+    def decode(self, text, image_type, fill='0xFF'):
+        handle = tempfile.NamedTemporaryFile(suffix='.txt')
+        try:
+            handle.write(text)
+            handle.flush()
+            options = optparse.Values({ 'type' : image_type, 'fill' : fill, 'verbose' : False })
+            return burn.decode_image(options, burn.get_input_file_data(handle.name, sys.maxsize))[:]
+        finally:
+            handle.close()
+
+    def assertDecodeError(self, text, image_type, message):
+        try:
+            self.decode(text, image_type)
+        except ValueError as e:
+            self.assertTrue(message in str(e), "%r not in %r" % (message, str(e)))
+        else:
+            self.fail("%s image decoded without error" % image_type)
+
+
+class IntelHexTest(DecodeTest):
+    def test_image_with_hole(self):
+        data = os.urandom(4096)
+        text = encode_intel_hex(0xFFF0, data[:1024]) + encode_intel_hex(0xFFF0 + 2048, data[2048:]) + \
+               intel_hex_record(1, 0)
+        self.assertEqual(self.decode(text, 'I'), data[:1024] + '\xFF' * 1024 + data[2048:])
+
+    def test_records_across_blocks(self):
+        data = os.urandom(64 * 1024)
+        saved = burn.DECODE_BLOCK_LEN, burn.RUN_BLOCK_RECORDS
+        burn.DECODE_BLOCK_LEN, burn.RUN_BLOCK_RECORDS = 1000, 7
+        try:
+            image = self.decode(encode_intel_hex(0x10000, data) + intel_hex_record(1, 0), 'I')
+        finally:
+            burn.DECODE_BLOCK_LEN, burn.RUN_BLOCK_RECORDS = saved
+        self.assertEqual(image, data)
+
+    def test_fill_byte(self):
+        text = intel_hex_record(0, 0, 'ab') + intel_hex_record(0, 4, 'cd') + intel_hex_record(1, 0)
+        self.assertEqual(self.decode(text, 'I', fill='0x00'), 'ab\x00\x00cd')
+
+    def test_extended_segment_address(self):
+        text = intel_hex_record(2, 0, '\x10\x00') + intel_hex_record(0, 0x10, 'ab') + \
+               intel_hex_record(2, 0, '\x10\x01') + intel_hex_record(0, 0x02, 'cd') + intel_hex_record(1, 0)
+        # 0x1000:0x0010 and 0x1001:0x0002 are linear 0x10010 and 0x10012
+        self.assertEqual(self.decode(text, 'I'), 'abcd')
+
+    def test_extended_linear_address(self):
+        text = intel_hex_record(4, 0, '\x00\x01') + intel_hex_record(0, 0xFFFE, 'ab') + \
+               intel_hex_record(4, 0, '\x00\x02') + intel_hex_record(0, 0, 'cd') + intel_hex_record(1, 0)
+        self.assertEqual(self.decode(text, 'I'), 'abcd')
+
+    def test_start_address_and_trailing_records_ignored(self):
+        text = intel_hex_record(3, 0, '\x00\x00\x12\x34') + intel_hex_record(0, 0, 'ab') + \
+               intel_hex_record(5, 0, '\x00\x00\x12\x34') + intel_hex_record(1, 0) + intel_hex_record(0, 8, 'cd')
+        self.assertEqual(self.decode(text, 'I'), 'ab')
+
+    def test_bad_checksum(self):
+        record = intel_hex_record(0, 0, 'ab')
+        record = record[:-3] + '%02X' % (int(record[-3:-1], 16) ^ 1) + '\n'
+        self.assertDecodeError(record + intel_hex_record(1, 0), 'I', 'record 1: bad checksum')
+
+    def test_bad_length(self):
+        record = intel_hex_record(0, 0, 'abc')
+        record = ':04' + record[3:]
+        self.assertDecodeError(record, 'I', 'record 1: wrong length')
+
+    def test_bad_hex_digits(self):
+        self.assertDecodeError(intel_hex_record(0, 0, 'ab').replace('61', 'G1'), 'I', 'bad hex digits')
+
+    def test_no_data(self):
+        self.assertDecodeError(intel_hex_record(1, 0), 'I', 'no data records')
+
+
+class SRecordTest(DecodeTest):
+    def test_image_with_hole(self):
+        data = os.urandom(4096)
+        text = srecord('0', 0, 'header') + encode_srecord(0x20000, data[:1024]) + \
+               encode_srecord(0x20000 + 2048, data[2048:]) + srecord('7', 0)
+        self.assertEqual(self.decode(text, 'M'), data[:1024] + '\xFF' * 1024 + data[2048:])
+
+    def test_records_across_blocks(self):
+        data = os.urandom(64 * 1024)
+        saved = burn.DECODE_BLOCK_LEN, burn.RUN_BLOCK_RECORDS
+        burn.DECODE_BLOCK_LEN, burn.RUN_BLOCK_RECORDS = 1000, 7
+        try:
+            image = self.decode(encode_srecord(0, data) + srecord('7', 0), 'M')
+        finally:
+            burn.DECODE_BLOCK_LEN, burn.RUN_BLOCK_RECORDS = saved
+        self.assertEqual(image, data)
+
+    def test_address_lengths(self):
+        text = srecord('1', 0x1234, 'ab') + srecord('2', 0x1236, 'cd') + srecord('3', 0x1238, 'ef') + \
+               srecord('9', 0)
+        self.assertEqual(self.decode(text, 'M'), 'abcdef')
+
+    def test_header_and_count_records_ignored(self):
+        text = srecord('0', 0, 'name') + srecord('1', 0, 'ab') + srecord('5', 1) + srecord('9', 0) + \
+               srecord('1', 8, 'cd')
+        self.assertEqual(self.decode(text, 'M'), 'ab')
+
+    def test_bad_checksum(self):
+        record = srecord('1', 0, 'ab')
+        record = record[:-3] + '%02X' % (int(record[-3:-1], 16) ^ 1) + '\n'
+        self.assertDecodeError(record + srecord('9', 0), 'M', 'S-record 1: bad checksum')
+
+    def test_bad_length(self):
+        record = srecord('1', 0, 'ab')
+        self.assertDecodeError('S109' + record[4:], 'M', 'S-record 1: wrong length')
+
+    def test_too_short_for_address(self):
+        self.assertDecodeError(srecord('3', 0, 'ab')[:2] + '02' + '00FD\n', 'M', 'S-record 1: wrong length')
+
+    def test_bad_hex_digits(self):
+        self.assertDecodeError(srecord('1', 0, 'ab').replace('61', 'G1'), 'M', 'bad hex digits')
+
+    def test_no_data(self):
+        self.assertDecodeError(srecord('0', 0, 'name') + srecord('9', 0), 'M', 'no data records')
+
+
+
+if __name__ == "__main__":
+    unittest.main()
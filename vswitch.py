@@ -0,0 +1,430 @@
+"""
+Description: Aggregate power switch built from any number of strips
+
+The VirtualPowerSwitch class allows programmers to create a single aggregate
+"switch" from a number of individual switches.  Their port numbers are defined
+by their order in the list of switches in the virtual device.
+
+A virtual switch can also be described by a config file so one lpower process
+covers every strip in a rack.  Sections other than [lpower] each describe one
+strip, in port order:
+
+    [lpower]
+    name = Lab Rack 3
+    settings = ~/.lpower
+    socket = ~/.lpower.sock
+
+    [Web-Power1]
+    type = dli
+    hostname = 192.168.168.251
+    user = admin
+    password = hwlab
+    ports = 8
+
+    [Web-Power2]
+    type = stech
+    hostname = 192.168.168.252
+    user = admin
+    password = hwlab
+    ports = 8
+
+Optional per strip keys: status_ttl, connect_timeout and read_timeout (seconds)
+and streaming (yes/no).
+
+Status can be printed as a table or, for scripts, as json, csv or tsv with
+one record per port: port, name, state and the strip (switch) it is on.
+
+A strip that fails a request is skipped for pwrlib.HEALTH_COOLDOWN seconds;
+status_list() reports its ports as Unknown so the other strips still answer.
+"""
+import os
+import sys
+import csv
+import json
+import time
+import StringIO
+import threading
+import ConfigParser
+import pwrlib
+
+CONFIG_SECTION = 'lpower'
+# Seconds a software power cycle keeps an outlet off
+RESET_DELAY = 4
+# Reset delay meaning "use the strip's own cycle action"
+NATIVE_CYCLE = 'native'
+SWITCH_TYPES = [ 'dli', 'stech' ]
+STATUS_FORMATS = [ 'table', 'json', 'csv', 'tsv' ]
+
+
+
+def _remap_port_numbers(ports, port_offset):
+    for port in ports:
+        port[0] = port[0] + port_offset
+
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _unknown_ports(dev):
+    """ Rows for a switch that can't be read, keeping the last names seen """
+    names = dev.status_cache.names()
+    return [[port, names.get(port, ''), 'Unknown'] for port in range(1, dev.get_num_ports() + 1)]
+
+
+def _fan_out(func, devices):
+    """
+    Call func(dev) for every device at the same time and return the results in
+    device order.  The first exception raised by any call is re-raised once all
+    calls have finished.
+    """
+    if len(devices) < 2:
+        return [func(dev) for dev in devices]
+    results = [None] * len(devices)
+    errors = [None] * len(devices)
+    def run(index, dev):
+        try:
+            results[index] = func(dev)
+        except Exception as e:
+            errors[index] = e
+    threads = [threading.Thread(target=run, args=(index, dev)) for index, dev in enumerate(devices)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for error in errors:
+        if error:
+            raise error
+    return results
+
+class VirtualPowerSwitch:
+    """
+    Collect a bunch of individual switches into one Virtual Switch so it can be
+    controlled as one.  Dispatch operations to each unit and remap ports as
+    appropriate.
+    """
+    def __init__(self, name="", switches=None, pool=None, status_ttl=None):
+        self.name = name
+        self.switches = switches or []
+        # Members share pwrlib.DEFAULT_POOL unless told otherwise
+        if pool:
+            for dev in self.switches:
+                dev.pool = pool
+        if status_ttl is not None:
+            self.set_status_ttl(status_ttl)
+
+    def set_status_ttl(self, status_ttl):
+        """ Set how long every member reuses its outlet list """
+        for dev in self.switches:
+            dev.status_cache.ttl = status_ttl
+
+    def status_ttls(self):
+        """ Each member's status ttl, for set_status_ttls to put back later """
+        return [dev.status_cache.ttl for dev in self.switches]
+
+    def set_status_ttls(self, status_ttls):
+        """ Restore member status ttls saved by status_ttls """
+        for dev, status_ttl in zip(self.switches, status_ttls):
+            dev.status_cache.ttl = status_ttl
+
+    def verify(self):
+        """ Verify we can reach all switches, returns true if ok """
+        for status in _fan_out(lambda dev: dev.verify(), self.switches):
+            if not status:
+                return False
+        return True
+
+    def off(self, outlet=0):
+        """ Turn off power to an outlet """
+        if outlet == 0:
+            return -1
+        for dev in self.switches:
+            if (outlet - dev.get_num_ports()) <= 0:
+                dev.off(outlet)
+                return 0
+            else:
+                outlet = outlet - dev.get_num_ports()
+        return -1
+
+    def on(self, outlet=0):
+        """ Turn on power to an outlet """
+        for dev in self.switches:
+            if (outlet - dev.get_num_ports()) <= 0:
+                dev.on(outlet)
+                return 0
+            else:
+                outlet = outlet - dev.get_num_ports()
+        return -1
+
+    def set_outlets(self, outlet_actions):
+        """
+        Apply a {outlet: action} map ('ON', 'OFF' or 'CCL').  Outlets are split per
+        member switch and each switch gets its share in one batch; the switches
+        are driven concurrently.  Returns -1 if any outlet is out of range.
+        """
+        batches = {}
+        for outlet, action in outlet_actions.items():
+            dev, dev_outlet = self._find_switch(outlet)
+            if dev is None:
+                return -1
+            batches.setdefault(dev, {})[dev_outlet] = action
+        devices = [dev for dev in self.switches if dev in batches]
+        _fan_out(lambda dev: dev.set_outlets(batches[dev]), devices)
+        return 0
+
+    def reset(self, outlet_delays, default_delay=RESET_DELAY):
+        """
+        Power cycle outlets.  outlet_delays maps outlet -> seconds to stay off,
+        None for default_delay, or NATIVE_CYCLE to use the strip's own cycle
+        action; default_delay may be NATIVE_CYCLE too.  A strip's cycle action
+        only cycles an outlet that is on, so it is only used for outlets that
+        read as ON and when the driver has one; the others get RESET_DELAY (or
+        a numeric default_delay).  Every outlet is switched off in one batch
+        and each is switched back on when its own delay is up, so a whole rack
+        takes about as long as its longest delay rather than one cycle per port.
+        Every outlet ends up on.  Returns -1 if any outlet is out of range.
+        """
+        fallback_delay = default_delay
+        if fallback_delay == NATIVE_CYCLE:
+            fallback_delay = RESET_DELAY
+        delays = {}
+        native = []
+        for outlet, delay in outlet_delays.items():
+            dev, dev_outlet = self._find_switch(outlet)
+            if dev is None:
+                return -1
+            if delay is None:
+                delay = default_delay
+            if delay == NATIVE_CYCLE:
+                delay = fallback_delay
+                if getattr(dev, 'supports_cycle', False):
+                    native.append(outlet)
+            delays[outlet] = delay
+
+        first_batch = {}
+        if native:
+            try:
+                rows = self.status_ports(sorted(native))
+            except Exception:
+                rows = []
+            for outlet, name, state in rows:
+                if state == 'ON':
+                    first_batch[outlet] = 'CCL'
+        timeline = {}
+        for outlet, delay in delays.items():
+            if not outlet in first_batch:
+                first_batch[outlet] = 'OFF'
+                timeline.setdefault(delay, []).append(outlet)
+        start = time.time()
+        self.set_outlets(first_batch)
+        for delay in sorted(timeline.keys()):
+            wait = start + delay - time.time()
+            if wait > 0:
+                with pwrlib.STATS.timer(self.name, 'reset_wait'):
+                    time.sleep(wait)
+            self.set_outlets(dict([(outlet, 'ON') for outlet in timeline[delay]]))
+        return 0
+
+    def _find_switch(self, outlet):
+        """ Map a virtual outlet to (switch, outlet on that switch) """
+        if outlet < 1:
+            return None, 0
+        for dev in self.switches:
+            if (outlet - dev.get_num_ports()) <= 0:
+                return dev, outlet
+            outlet = outlet - dev.get_num_ports()
+        return None, 0
+
+    def status_list(self):
+        """
+        Return the status of all outlets in a list, each item will contain 3
+        itmes plugnumber, hostname and state.  Ports of a switch that is down
+        or fails to answer are Unknown; if no switch answers the first error is
+        raised.
+        """
+        outlets = []
+        port_offset = 0
+        results = self._read_status(self.switches)
+        for dev in self.switches:
+            ports = results[dev]
+            _remap_port_numbers(ports, port_offset)
+            port_offset = port_offset + dev.get_num_ports()
+            outlets.extend(ports)
+        return outlets
+
+    def status_ports(self, outlets):
+        """
+        Return [plugnumber, hostname, state] rows for just the given outlets, in
+        the order given.  Each switch that owns one of them is read once however
+        many of its outlets are asked for, and the other switches aren't read.
+        """
+        owners = []
+        devices = []
+        for outlet in outlets:
+            dev, dev_outlet = self._find_switch(outlet)
+            if dev is None:
+                raise Exception("Invalid port number %d" % outlet)
+            owners.append((outlet, dev, dev_outlet))
+            if not dev in devices:
+                devices.append(dev)
+        results = self._read_status(devices)
+        rows = []
+        for outlet, dev, dev_outlet in owners:
+            row = [outlet, '', 'Unknown']
+            for port in results[dev]:
+                if port[0] == dev_outlet:
+                    row = [outlet, port[1], port[2]]
+            rows.append(row)
+        return rows
+
+    def _read_status(self, devices):
+        """
+        Read every device at once, returns {device: rows in its own numbering}.
+        Devices that are down or fail to answer get Unknown rows; if none of
+        them answers the first error is raised.
+        """
+        errors = []
+        def read(dev):
+            try:
+                return dev.status_list() or _unknown_ports(dev)
+            except Exception as e:
+                errors.append(e)
+                return _unknown_ports(dev)
+        results = _fan_out(read, devices)
+        if errors and len(errors) == len(devices):
+            raise errors[0]
+        return dict(zip(devices, results))
+
+    def print_status(self, outlet_list=None, format='table'):
+        """
+        Print the status of all the outlets, or the rows in outlet_list, to
+        stdout as a table or in one of the other STATUS_FORMATS.  Returns the
+        rows printed.
+        """
+        if outlet_list is None:
+            outlet_list = self.status_list() or []
+        if format != 'table':
+            sys.stdout.write(self.format_status(outlet_list, format))
+            return outlet_list
+        if not outlet_list:
+            return outlet_list
+        print "\n%s (%s)" % (self.name, ', '.join([dev.hostname for dev in self.switches]))
+        print 'Port\t%-15s\tState' % 'Hostname'
+        for item in outlet_list:
+            print '%d\t%-15s\t%s' % (item[0], item[1], item[2])
+        for dev in self.switches:
+            if not dev.health.available():
+                print 'Note: %s' % dev.health
+        return outlet_list
+
+    def format_status(self, outlet_list, format):
+        """ Status rows as json, csv or tsv text, one record per port """
+        records = []
+        for item in outlet_list:
+            dev, dev_outlet = self._find_switch(item[0])
+            records.append({ 'port'   : item[0],
+                             'name'   : item[1],
+                             'state'  : item[2],
+                             'switch' : dev and dev.hostname or '' })
+        fields = [ 'port', 'name', 'state', 'switch' ]
+        if format == 'json':
+            return json.dumps(records, indent=2, sort_keys=True) + '\n'
+        if format == 'csv':
+            output = StringIO.StringIO()
+            writer = csv.DictWriter(output, fields, lineterminator='\n')
+            writer.writerow(dict(zip(fields, fields)))
+            for record in records:
+                writer.writerow(dict([(key, _utf8(value)) for key, value in record.items()]))
+            return output.getvalue()
+        if format == 'tsv':
+            lines = [ '\t'.join(fields) ]
+            for record in records:
+                lines.append('\t'.join([_utf8(record[key]).replace('\t', ' ') for key in fields]))
+            return '\n'.join(lines) + '\n'
+        raise Exception("Unknown status format %s (%s)" % (format, ', '.join(STATUS_FORMATS)))
+
+    def get_num_ports(self):
+        """ Total ports for all virtual ports """
+        num_ports = 0
+        for dev in self.switches:
+            num_ports = num_ports + dev.get_num_ports()
+        return num_ports
+
+    def status(self, outlet=1):
+        """
+        Return the status of an outlet, returned value will be one of: On, Off,
+        Unknown.  Only the switch that owns the outlet is queried.
+        """
+        dev, dev_outlet = self._find_switch(outlet)
+        if dev is None or not dev.health.available():
+            return 'Unknown'
+        try:
+            return dev.status(dev_outlet)
+        except Exception:
+            return 'Unknown'
+
+
+
+def read_config(filename):
+    """
+    Parse a switch config file.  Returns a dict of [lpower] options and a list
+    of per-strip option dicts in port order.  Raises an exception describing the
+    first problem found.
+    """
+    parser = ConfigParser.RawConfigParser()
+    if not parser.read(os.path.expanduser(filename)):
+        raise Exception("Could not read switch config %s" % filename)
+    options = {}
+    if parser.has_section(CONFIG_SECTION):
+        options = dict(parser.items(CONFIG_SECTION))
+    specs = []
+    for section in parser.sections():
+        if section == CONFIG_SECTION:
+            continue
+        spec = dict(parser.items(section))
+        spec['name'] = section
+        spec.setdefault('type', 'dli')
+        if not spec['type'] in SWITCH_TYPES:
+            raise Exception("%s: unknown switch type %s (%s)" % (section, spec['type'], ', '.join(SWITCH_TYPES)))
+        if not spec.has_key('hostname'):
+            raise Exception("%s: missing hostname" % section)
+        try:
+            spec['ports'] = int(spec.get('ports', 8))
+        except ValueError:
+            raise Exception("%s: ports must be a number" % section)
+        specs.append(spec)
+    if not specs:
+        raise Exception("No switches defined in %s" % filename)
+    return options, specs
+
+
+def build_switch(options, specs):
+    """
+    Create a VirtualPowerSwitch from the output of read_config().  Stech
+    sessions are kept on disk (options 'sessions', empty to disable) because
+    each CLI invocation is a separate process.
+    """
+    import dli
+    import stech
+    session_dir = options.get('sessions', stech.SESSION_DIR)
+    sessions = pwrlib.SessionCache(directory=session_dir and os.path.expanduser(session_dir) or None)
+    switches = []
+    for spec in specs:
+        kwargs = { 'userid'     : spec.get('user', 'admin'),
+                   'password'   : spec.get('password', '4321'),
+                   'hostname'   : spec['hostname'],
+                   'num_ports'  : spec['ports'] }
+        if spec.has_key('status_ttl'):
+            kwargs['status_ttl'] = float(spec['status_ttl'])
+        for key in ('connect_timeout', 'read_timeout'):
+            if spec.has_key(key):
+                kwargs[key] = float(spec[key])
+        if spec.has_key('streaming'):
+            kwargs['streaming'] = spec['streaming'].lower() in ('1', 'yes', 'true', 'on')
+        if spec['type'] == 'stech':
+            switches.append(stech.StechPowerSwitch(sessions=sessions, **kwargs))
+        else:
+            switches.append(dli.DliPowerSwitch(**kwargs))
+    return VirtualPowerSwitch(name=options.get('name', 'lpower'), switches=switches)